@@ -0,0 +1,40 @@
+#!/bin/env python3
+"""
+bench_ast -- lexing a document vs loading its cached AST;
+
+    % python bench/bench_ast.py [<scale>]      # default: samples x 1,000
+"""
+
+if True:
+    import os
+    import sys
+    import tempfile
+    import time
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import hroff
+    from   synth import scaled_samples
+
+
+def best_of(f, repeat: int = 3) -> float:
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'big.hroff')
+        with open(fn, 'w') as ofd:
+            ofd.writelines(f"{ln}\n" for ln in scaled_samples(scale))
+        lines = list(hroff.HROFFFile._iter_lines(open(fn, 'r')))
+        hroff.save_ast(fn, hroff.parse_document(lines))
+        lex = best_of(lambda: hroff.parse_document(list(hroff.HROFFFile._iter_lines(open(fn, 'r')))))
+        load = best_of(lambda: hroff.load_ast(fn))
+    print(f"{len(lines)} lines")
+    print(f"read + lex: {lex * 1000:8.1f} ms")
+    print(f"load AST:   {load * 1000:8.1f} ms  ({lex / load:.1f}x faster)")
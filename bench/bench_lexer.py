@@ -0,0 +1,42 @@
+#!/bin/env python3
+"""
+bench_lexer -- Components parse throughput (lines/sec), single-pass lexer vs the reference parser;
+
+    % python bench/bench_lexer.py [<scale>]     # default: samples x 10,000
+"""
+
+if True:
+    import os
+    import sys
+    import time
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import hroff
+    from   synth import scaled_samples
+
+TARGET_LINES_PER_SEC = 300000   # single core, samples x 10,000 (~450k measured, reference parser ~225k);
+
+
+def throughput(lines, repeat: int = 3, **kwa) -> float:
+    """Best of repeat runs, in lines/sec"""
+    Components = hroff.Components
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for ln in lines:
+            Components(ln, **kwa)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return len(lines) / best
+
+
+if __name__ == "__main__":
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    lines = list(scaled_samples(scale))
+    reference = throughput(lines, reference=True)
+    lexer = throughput(lines)
+    print(f"{len(lines)} lines")
+    print(f"reference parser: {reference:10.0f} lines/s")
+    print(f"single-pass:      {lexer:10.0f} lines/s  ({lexer / reference:.2f}x)")
+    if lexer < TARGET_LINES_PER_SEC:
+        print(f"below target of {TARGET_LINES_PER_SEC} lines/s")
+        sys.exit(1)
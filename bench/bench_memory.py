@@ -0,0 +1,50 @@
+#!/bin/env python3
+"""
+bench_memory -- bytes per parsed line for Components, against the old dict-per-line layout;
+
+    % python bench/bench_memory.py [<scale>]
+"""
+
+if True:
+    import os
+    import sys
+    import tracemalloc
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import hroff
+    from   synth import scaled_samples
+
+
+class LegacyComponents(dict):
+    """What every line cost before: a dict subclass, with the subterms dict always materialized"""
+
+
+def measure(make, lines) -> int:
+    tracemalloc.start()
+    held = make(lines)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del held
+    return size
+
+
+def tokens(lines):
+    return [ hroff.Components(ln) for ln in lines ]
+
+
+def legacy(lines):
+    held = [ ]
+    for ln in lines:
+        c = hroff.Components(ln)
+        held.append(LegacyComponents(c.as_dict()))  # Same lists/strings, old container layout;
+    return held
+
+
+if __name__ == "__main__":
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    lines = list(scaled_samples(scale))
+    n = len(lines)
+    before = measure(legacy, lines)
+    after = measure(tokens, lines)
+    print(f"{n} lines")
+    print(f"dict layout:    {before / n:8.1f} bytes/line")
+    print(f"slotted tokens: {after / n:8.1f} bytes/line  ({100.0 * (before - after) / before:.0f}% less)")
@@ -0,0 +1,325 @@
+#!/bin/env python3
+"""
+golden -- golden corpus and differential check: every render path has to produce the same bytes;
+
+    % python bench/golden.py                                # each path vs the stored bench/golden/<case>.html
+    % python bench/golden.py --update                       # rewrite those from the reference path
+    % python bench/golden.py --random 5 [--lines 20000] [--seed 1] [--path <name> ...]
+
+The corpus is samples/*.hroff plus the generated cases in CASES, which put every tag hroff knows (from
+HROFFFile.HANDLERS, read at run time, so tags added with register_tag are covered too) through each line
+form, and every directive.  The reference path is a serial render lexed by the reference parser; every path in
+PATHS renders the same file and has to match it, and the golden, byte for byte.  An exception is an output too:
+all paths have to fail the same way.  --random also diffs randomly generated documents and reports how long
+each path took relative to the reference.  Last, hroff_server's renders are checked to stay under --root.
+"""
+
+if True:
+    import argparse
+    import contextlib
+    import difflib
+    import glob
+    import io
+    import os
+    import random
+    import shutil
+    import sys
+    import tempfile
+    import time
+    BENCH = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.dirname(BENCH))
+    import hroff
+    from   synth import SAMPLES, write_lines
+
+GOLDEN = os.path.join(BENCH, 'golden')
+WORDS = ( 'alpha', 'Bravo', 'charlie', '3/4', 'x&y', '<b>', '"quoted"', "it's", 'width="10%"', 'id=z', 'ü',
+          '::', '//', '..', 'a//b', 'c::d', 'http://example.com/p?q=1&r=2' )
+
+
+def tags() -> list:
+    names = { name for type_, name in hroff.HROFFFile.HANDLERS if type_ == 'start' and name }
+    return sorted(names - { 'title', 'css', 'js' })     # Head tags are exercised by the directives case;
+
+
+def tag_lines(tag: str) -> list:
+    """One tag in every line form: bare, text, options, '::' children, '//' fields, both, closed"""
+    return [ f".{tag}", f".{tag} plain text", f'.{tag} class="c" id="{tag}1"', f".{tag} :: child text",
+             f'.{tag} class="c" :: child // second', f".{tag} one // two // three",
+             f'.{tag} name="n" id="i" :: value="v1" :: First // Second // value="v3" :: Third',
+             f".{tag}  spaced   out  ", f"..{tag}" ]
+
+
+def tags_case() -> list:
+    # A document per line, so a line that raises doesn't hide the rest;
+    return [ [ f".title {tag}", f"#{tag}", ln ] for tag in tags() for ln in tag_lines(tag) ]
+
+
+def text_case() -> list:
+    return [ [ ".title Text, comments and oddities", "Plain text line", "  indented text", "text with <b>html</b> & such",
+             "; hroff comment", ";; another", "# html comment", "#", "#  padded comment  ", "", "",
+             ", continuation line", ".p", "..p", "..", ".", ".unknowntag with args", "..unknowntag", "@at line",
+             ".p unicode — ü ß 中文", ".tr a//b//c", ".tr a :: b", ".td :: ", ".th //", ".h1", ".select", ".tdselect ::" ] ]
+
+
+def directives_case() -> list:
+    return [ [ ".title First title", "!define line x", "{{x}}", "!enddefine", "!macro line .title Directives",
+             ".title Later title", "!macro line .title Directives", ".css style.css", ".css style.css inline",
+             ".css style.css inline min", ".js script.js", "!js script.js inline min", "!css http://example.com/x.css", ".div",
+             "!include part.hroff", "!fragment frag.html", "!include missing.hroff", "!fragment missing.html",
+             "..div", ".table", "!table-data rows.csv header", "!table-data rows.csv escape columns=name,1",
+             "!table-data rows.tsv format=tsv", "!table-data rows.jsonl columns=b", "..table",
+             "!define box title body", ".div class=\"box\"", ".h3 {{title}}", ".p {{body}}", "..p", "..div",
+             "!enddefine", "!macro box One // first body", "!macro box Two // second // extra", "!macro box",
+             "!macro nosuch a // b", "!define cap x", ".caption class=\"c\" :: a :: b :: c", ".p {{x}}", "..p",
+             "!enddefine", "!macro cap one", "!macro cap two", "!macro cap three",
+             "!define cap x", ".h4 {{x}} redefined", "!enddefine", "!macro cap one", "!bogus directive", "!exit", ".p after exit" ] ]
+
+
+def directive_files(dirpath: str) -> None:
+    """The files directives_case (and random documents) refer to"""
+    write_lines(os.path.join(dirpath, 'part.hroff'), [ ".p included", "!include part2.hroff", "..p" ])
+    write_lines(os.path.join(dirpath, 'part2.hroff'), [ ".b nested", "!fragment frag.html" ])
+    write_lines(os.path.join(dirpath, 'frag.html'), [ "<hr class=\"frag\">", "  raw & <untouched>" ])
+    write_lines(os.path.join(dirpath, 'style.css'), [ "/* comment */", "body {", "    color : red ;", "}" ])
+    write_lines(os.path.join(dirpath, 'script.js'), [ "// comment", "function f ( a ) {", "    return a + 1 ;", "}" ])
+    write_lines(os.path.join(dirpath, 'rows.csv'), [ "name,value,note", "a,1,<x>", "", "b,2,\"quoted, comma\"" ])
+    write_lines(os.path.join(dirpath, 'rows.tsv'), [ "a\tb", "1\t2" ])
+    write_lines(os.path.join(dirpath, 'rows.jsonl'), [ '{"a": 1, "b": "&"}', '{"b": [1, 2]}' ])
+
+
+# name -> the documents (lists of lines) of a generated corpus case; their outputs make up its golden;
+CASES = dict(tags=tags_case, text=text_case, directives=directives_case)
+
+
+def random_document(rng: random.Random, count: int) -> list:
+    """count lines drawn from every tag form, text, comments and includes, in random order and nesting
+
+    Forms that raise on their own (the corpus has those) are left out, or the first one would end the document."""
+    pool = [ ln for tag in tags() for ln in tag_lines(tag) if _renders(ln) ]
+    lines = [ f".title Random {rng.random()}" ]
+    while len(lines) < count:
+        roll = rng.random()
+        if roll < 0.45:
+            ln = rng.choice(pool)
+            if '::' in ln or '//' in ln:
+                ln = ln.replace('child', rng.choice(WORDS)).replace('two', ' '.join(rng.choices(WORDS, k=3)))
+            lines.append(ln)
+        elif roll < 0.7:
+            lines.append(' '.join(rng.choices(WORDS, k=rng.randint(1, 8))))
+        elif roll < 0.8:
+            lines.append(f".tr {' // '.join(rng.choices(WORDS, k=rng.randint(1, 6)))}")
+        elif roll < 0.88:
+            lines.append(rng.choice(( '#', ';', '# ', ', ' )) + ' '.join(rng.choices(WORDS, k=3)))
+        elif roll < 0.95:
+            lines.append(f"..{rng.choice(tags())}")
+        elif roll < 0.98:
+            lines.append("")
+        else:
+            lines.append(rng.choice(( "!include part.hroff", "!fragment frag.html" )))
+    return lines
+
+
+def _renders(ln: str) -> bool:
+    try:
+        hroff.HROFFFile('<line>', lines=[ ln ], reference=True).run()
+        return True
+    except Exception:
+        return False
+
+
+def _render(fn: str, ofn: str, **kwa) -> None:
+    doc = hroff.HROFFFile(fn, **kwa)
+    doc.run()
+    doc.save(ofn)
+
+
+def _chunked(fn: str, ofn: str) -> None:
+    # Every file is big enough to split here; the workers are forked, so they see the same threshold;
+    was = hroff.HROFFFile.CHUNK_MIN_BYTES
+    hroff.HROFFFile.CHUNK_MIN_BYTES = 0
+    try:
+        _render(fn, ofn, chunk_jobs=2)
+    finally:
+        hroff.HROFFFile.CHUNK_MIN_BYTES = was
+
+
+# name -> ( setup(fn) run untimed first, or None, render(fn, ofn) ); each starts from an empty SOURCE_CACHE
+# unless its setup fills it;
+PATHS = dict(
+    lexer=( None, _render ),
+    warm=( lambda fn: _render(fn, f"{fn}.warm"), _render ),
+    ast=( lambda fn: _render(fn, f"{fn}.ast.html", ast_cache=True), lambda fn, ofn: _render(fn, ofn, ast_cache=True) ),
+    stream=( None, lambda fn, ofn: hroff.HROFFFile(fn, stream=True).save(ofn) ),
+    chunked=( None, _chunked ),
+    prefetch=( None, lambda fn, ofn: _render(fn, ofn, prefetch=4) ),
+)
+
+
+def outcome(render, fn: str, ofn: str) -> tuple:
+    """( output bytes, or the exception as text, seconds )"""
+    t0 = time.perf_counter()
+    try:
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):  # !exit reports itself on stdout;
+                render(fn, ofn)
+        except SystemExit:
+            ofn = f"{os.path.splitext(fn)[0]}.html"  # !exit saved the page under its default name, and quit;
+        seconds = time.perf_counter() - t0
+        with open(ofn, 'rb') as ifd:
+            return ifd.read(), seconds
+    except Exception as e:
+        return f"{type(e).__name__}: {e}\n".encode(), time.perf_counter() - t0
+
+
+def run_paths(fn: str, paths: list) -> dict:
+    """path name -> ( output, seconds ) for fn, the reference included"""
+    results = { }
+    for name in [ 'reference' ] + paths:
+        hroff.SOURCE_CACHE.clear()
+        setup, render = ( None, lambda fn, ofn: _render(fn, ofn, reference=True) ) if name == 'reference' else PATHS[name]
+        if setup is not None:
+            outcome(lambda fn, ofn: setup(fn), fn, f"{fn}.setup.html")
+        results[name] = outcome(render, fn, f"{fn}.{name}.html")
+    return results
+
+
+def diff(name: str, expected: bytes, got: bytes, limit: int = 20) -> str:
+    lines = difflib.unified_diff(expected.decode('utf-8', 'replace').splitlines(),
+                                 got.decode('utf-8', 'replace').splitlines(), 'expected', name, lineterm='', n=1)
+    return "\n".join(list(lines)[:limit])
+
+
+def corpus(dirpath: str) -> list:
+    """Write the corpus to dirpath: [ ( case name, [ source paths ] ) ]"""
+    cases = [ ]
+    for fn in sorted(glob.glob(os.path.join(SAMPLES, '*'))):
+        if not fn.endswith(( '.html', '.gz', '.etag' )):
+            shutil.copy(fn, dirpath)
+        if fn.endswith('.hroff'):
+            cases.append(( os.path.splitext(os.path.basename(fn))[0], [ os.path.join(dirpath, os.path.basename(fn)) ] ))
+    directive_files(dirpath)
+    for name, documents in sorted(CASES.items()):
+        fns = [ ]
+        for n, lines in enumerate(documents()):
+            fns.append(os.path.join(dirpath, f"{name}-{n}.hroff"))
+            write_lines(fns[-1], lines)
+        cases.append(( name, fns ))
+    return cases
+
+
+def case_outputs(fns: list, paths: list) -> dict:
+    """path name -> the case's output: its documents' outputs, each after a marker line if there are several"""
+    outputs = { }
+    for fn in fns:
+        for path, ( output, _ ) in run_paths(fn, paths).items():
+            marker = f"<!-- {os.path.basename(fn)} -->\n".encode() if len(fns) > 1 else b""
+            outputs[path] = outputs.get(path, b"") + marker + output + (b"\n" if marker else b"")
+    return outputs
+
+
+def check_corpus(paths: list, update: bool) -> int:
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, fns in corpus(tmp):
+            outputs = case_outputs(fns, [ ] if update else paths)
+            golden = os.path.join(GOLDEN, f"{name}.html")
+            if update:
+                with open(golden, 'wb') as ofd:
+                    ofd.write(outputs['reference'])
+                print(f"{name:20s} written")
+                continue
+            with open(golden, 'rb') as ifd:
+                expected = ifd.read()
+            bad = [ path for path, output in outputs.items() if output != expected ]
+            print(f"{name:20s} {'ok' if not bad else 'MISMATCH ' + ' '.join(bad)}")
+            for path in bad:
+                print(diff(path, expected, outputs[path]))
+            failures += len(bad)
+    return failures
+
+
+def check_random(count: int, lines: int, seed: int, paths: list) -> int:
+    failures = 0
+    seconds = dict.fromkeys([ 'reference' ] + paths, 0.0)
+    with tempfile.TemporaryDirectory() as tmp:
+        directive_files(tmp)
+        for n in range(count):
+            fn = os.path.join(tmp, f"random{n}.hroff")
+            write_lines(fn, random_document(random.Random(seed + n), lines))
+            results = run_paths(fn, paths)
+            expected = results['reference'][0]
+            for path, ( output, elapsed ) in results.items():
+                seconds[path] += elapsed
+                if output != expected:
+                    failures += 1
+                    kept = os.path.join(tempfile.gettempdir(), f"hroff-golden-seed{seed + n}.hroff")
+                    shutil.copy(fn, kept)
+                    print(f"random seed {seed + n}: MISMATCH {path} (source kept as {kept})")
+                    print(diff(path, expected, output))
+    total = count * lines
+    for path, elapsed in seconds.items():
+        print(f"{path:10s} {elapsed * 1000:9.1f} ms {total / elapsed if elapsed else 0:10.0f} lines/s "
+              f"{seconds['reference'] / elapsed if elapsed else 0:6.2f}x reference")
+    return failures
+
+
+def check_server_root() -> int:
+    """hroff_server reads nothing outside its root (escaping names are missing files), and writes nothing and never
+    exits: !exit just ends the document; in GET and POST renders"""
+    import hroff_server
+    escapes = [ "/etc/passwd", "../../../../../../etc/passwd", "link/passwd" ]
+    exits = [ ".p hello", "!exit", ".p after" ]
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.realpath(os.path.join(tmp, 'root'))
+        os.makedirs(os.path.join(root, 'sub'))
+        os.symlink('/etc', os.path.join(root, 'link'))
+        directive_files(root)
+        lines = [ "!include part.hroff" ] + [ f"!{directive} {name}" for name in escapes for directive in ( 'fragment', 'include' ) ]
+        write_lines(os.path.join(root, 'sub', 'page.hroff'), lines)
+        write_lines(os.path.join(root, 'ex.hroff'), exits)
+        renders = dict(POST=lambda: hroff_server._render_text("\n".join(lines), root),
+                       GET=lambda: hroff_server._render_path(os.path.join(root, 'sub', 'page.hroff'), root))
+        exit_renders = dict(POST=lambda: hroff_server._render_text("\n".join(exits), root),
+                            GET=lambda: hroff_server._render_path(os.path.join(root, 'ex.hroff'), root))
+        for method, render in renders.items():
+            html, deps = render()
+            missing = [ name for name in escapes if f"WARNING: No such fragment file {name}:" in html
+                                                  and f"WARNING: No such include file {name}:" in html ]
+            bad = 'root:' in html or missing != escapes or 'class="frag"' not in html or any(
+                not dep.startswith(root + os.sep) for dep in deps)
+            print(f"{'server-root ' + method:20s} {'ESCAPED' if bad else 'ok'}")
+            failures += bad
+        for method, render in exit_renders.items():
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    html = render()[0]
+                bad = 'hello' not in html or 'after' in html or os.path.exists(os.path.join(root, 'ex.html'))
+            except BaseException:
+                bad = True
+            print(f"{'server-exit ' + method:20s} {'FAILED' if bad else 'ok'}")
+            failures += bad
+    return failures
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(prog='bench/golden.py')
+    parser.add_argument('--path', action='append', choices=sorted(PATHS), help="default: all")
+    parser.add_argument('--update', action='store_true', help="rewrite the goldens from the reference path")
+    parser.add_argument('--random', type=int, default=0, metavar='N', help="also diff N random documents")
+    parser.add_argument('--lines', type=int, default=20000, help="lines per random document")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    paths = args.path or list(PATHS)
+    failures = check_corpus(paths, args.update)
+    if not args.update:
+        failures += check_server_root()
+    if args.random and not args.update:
+        failures += check_random(args.random, args.lines, args.seed, paths)
+    if failures:
+        print(f"{failures} mismatches")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
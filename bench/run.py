@@ -0,0 +1,178 @@
+#!/bin/env python3
+"""
+run -- the benchmark suite: parse, render and save timed separately on synthetic inputs;
+
+    % python bench/run.py [--scale N] [--case <name> ...] [--threshold 0.3] [--update-baseline]
+
+Each case runs in a fresh interpreter, so peak RSS is its own.  Each phase is timed as the best of REPEAT samples
+of at least MIN_SECONDS, and lines count what a page renders, includes expanded.  Results are compared with
+baseline.json (lines/sec may not drop, and peak RSS may not grow, by more than the threshold); any regression
+exits 1.
+"""
+
+if True:
+    import argparse
+    import itertools
+    import json
+    import math
+    import os
+    import resource
+    import subprocess
+    import sys
+    import tempfile
+    import time
+    BENCH = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.dirname(BENCH))
+    import hroff
+    import synth
+
+BASELINE = os.path.join(BENCH, 'baseline.json')
+PHASES = ( 'parse', 'render', 'save' )
+REPEAT = 5              # Samples per phase, the fastest kept;
+MIN_SECONDS = 0.05      # A sample repeats its phase until it takes this long;
+
+
+def peak_rss_kb() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def expanded_lines(fn: str, lookups: hroff.FileLookups = None) -> int:
+    """Lines fn renders, counting each !include/!fragment as the lines of its file (as often as it's named)"""
+    lookups = lookups or hroff.FileLookups()
+    count = 0
+    for ln in hroff.SOURCE_CACHE.lines(fn):
+        fields = ln.split()
+        if fields and fields[0] in ( '!include', '!fragment' ) and len(fields) > 1:
+            path = lookups.locate(fields[-1], os.path.dirname(fn))
+            if path is not None:
+                count += expanded_lines(path, lookups) if fields[0] == '!include' else len(hroff.SOURCE_CACHE.lines(path))
+                continue
+        count += 1
+    return count
+
+
+def best(prepare, work, repeat: int, min_seconds: float, cleanup = None) -> float:
+    """Fastest seconds per work(prepare()) over repeat samples, each calling it often enough to take min_seconds
+
+    prepare() runs untimed and gives each call a fresh argument, so no call sees an earlier one's caches;
+    cleanup(arguments), if given, runs untimed after each sample."""
+    t0 = time.perf_counter()
+    args = [ prepare() ]
+    work(args[0])
+    if cleanup is not None:
+        cleanup(args)
+    number = max(1, math.ceil(min_seconds / max(time.perf_counter() - t0, 1e-6)))
+    fastest = None
+    for _ in range(repeat):
+        args = [ prepare() for _ in range(number) ]
+        t0 = time.perf_counter()
+        for arg in args:
+            work(arg)
+        seconds = (time.perf_counter() - t0) / number
+        fastest = seconds if fastest is None else min(fastest, seconds)
+        if cleanup is not None:
+            cleanup(args)
+        del args
+    return fastest
+
+
+def measure(fn: str, repeat: int = REPEAT, min_seconds: float = MIN_SECONDS) -> dict:
+    """Run in the child: time each phase of rendering fn, with peak RSS after each
+
+    Peak RSS comes from one plain parse, render and save.  The times are then each phase's best (see best), every
+    render starting from fresh tokens and an empty SOURCE_CACHE, so includes are expanded each time.  Parsing only
+    lexes fn itself, so its lines/s counts the tokens parsed rather than the expanded lines the other phases do."""
+    def parse(_ = None) -> list:
+        return hroff.parse_document(hroff.HROFFFile(fn)._ibuf)
+
+    def render(tokens: list) -> hroff.HROFFFile:
+        hroff.SOURCE_CACHE.clear()
+        doc = hroff.HROFFFile(fn)
+        for components in tokens:
+            doc._dispatch(components)
+        return doc
+
+    result = dict(lines=expanded_lines(fn))
+    tokens = parse()
+    result['parsed_lines'] = len(tokens)
+    result['parse'] = dict(rss_kb=peak_rss_kb())
+    doc = render(tokens)
+    result['render'] = dict(rss_kb=peak_rss_kb())
+    doc.save(f"{fn}.html")
+    result['save'] = dict(rss_kb=peak_rss_kb())
+    del tokens
+
+    # A new file each save, as the first save writes; removed after the sample, before the disk is written back;
+    outputs = ( f"{fn}.{n}.html" for n in itertools.count() )
+    result['parse']['seconds'] = best(lambda: None, parse, repeat, min_seconds)
+    result['render']['seconds'] = best(parse, render, repeat, min_seconds)
+    result['save']['seconds'] = best(lambda: next(outputs), doc.save, repeat, min_seconds,
+                                     cleanup=lambda ofns: [ os.remove(ofn) for ofn in ofns ])
+    for phase in PHASES:
+        seconds, lines = result[phase]['seconds'], result['parsed_lines' if phase == 'parse' else 'lines']
+        result[phase]['lines_per_sec'] = lines / seconds if seconds else 0.0
+    return result
+
+
+def run_case(name: str, scale: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = synth.CASES[name](tmp, scale)
+        proc = subprocess.run([ sys.executable, os.path.abspath(__file__), '--child', fn ],
+                              capture_output=True, text=True, check=True)
+    return json.loads(proc.stdout)
+
+
+def regressions(name: str, result: dict, baseline: dict, threshold: float) -> list:
+    failed = [ ]
+    base = baseline.get(name, None)
+    if not base:
+        return failed
+    for phase in PHASES:
+        was, now = base[phase]['lines_per_sec'], result[phase]['lines_per_sec']
+        if now < was * (1.0 - threshold):
+            failed.append(f"{name}.{phase}: {now:.0f} lines/s, baseline {was:.0f}")
+        was, now = base[phase]['rss_kb'], result[phase]['rss_kb']
+        if now > was * (1.0 + threshold):
+            failed.append(f"{name}.{phase}: peak RSS {now} KB, baseline {was} KB")
+    return failed
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(prog='bench/run.py')
+    parser.add_argument('--case', action='append', choices=sorted(synth.CASES), help="default: all")
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--threshold', type=float, default=0.3, help="allowed fractional regression")
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        print(json.dumps(measure(args.child)))
+        return 0
+
+    baseline = { }
+    if os.path.isfile(BASELINE):
+        with open(BASELINE, 'r') as ifd:
+            baseline = json.load(ifd)
+    results, failed = { }, [ ]
+    for name in args.case or sorted(synth.CASES):
+        result = results[name] = run_case(name, args.scale)
+        print(f"{name:12s} {result['lines']:9d} lines", end='')
+        for phase in PHASES:
+            r = result[phase]
+            print(f"  {phase} {r['seconds'] * 1000:8.1f} ms {r['lines_per_sec']:9.0f}/s {r['rss_kb'] // 1024:5d} MB",
+                  end='')
+        print()
+        if args.scale == 1:
+            failed += regressions(name, result, baseline, args.threshold)
+    if args.update_baseline:
+        baseline.update(results)
+        with open(BASELINE, 'w') as ofd:
+            json.dump(baseline, ofd, indent=1, sort_keys=True)
+        return 0
+    for failure in failed:
+        print(f"REGRESSION {failure}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
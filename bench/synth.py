@@ -0,0 +1,112 @@
+"""
+synth -- synthetic hroff inputs for the benchmarks in this directory;
+"""
+
+if True:
+    import glob
+    import os
+    from   typing import Iterator, List
+
+SAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'samples')
+
+
+def sample_lines() -> List[str]:
+    """Every line of samples/*.hroff, in a stable order, as HROFFFile._load would see them"""
+    lines = [ ]
+    for fn in sorted(glob.glob(os.path.join(SAMPLES, '*.hroff'))):
+        with open(fn, 'r') as ifd:
+            lines += [ ln[:-1] for ln in ifd if not ln.startswith(';') ]
+    return lines
+
+
+def scaled_samples(factor: int) -> Iterator[str]:
+    """The sample corpus repeated factor times (directives dropped, they need real files)"""
+    lines = [ ln for ln in sample_lines() if not ln.startswith('!') ]
+    for _ in range(factor):
+        yield from lines
+
+
+def table_rows(rows: int, cols: int = 8) -> Iterator[str]:
+    """A table written both ways: '.tr a // b // c' rows and '.tr' + '.td a // b' cell rows"""
+    yield ".title Synthetic table"
+    yield '.table width="100%" border=1'
+    yield f".tr {' // '.join(f'Header {c}' for c in range(cols))}"
+    for r in range(rows):
+        if r % 2:
+            yield f".tr {' // '.join(f'r{r}c{c}' for c in range(cols))}"
+        else:
+            yield ".tr"
+            yield f".td {' // '.join(f'r{r}c{c}' for c in range(cols))}"
+            yield "..tr"
+    yield "..table"
+
+
+def select_options(selects: int, options: int) -> Iterator[str]:
+    """.select and .tdselect lines with thousands of '::'/'//' options each"""
+    yield ".title Synthetic selects"
+    for s in range(selects):
+        opts = ' // '.join(f'value="v{o}" :: Option {o}' if o % 3 == 0 else f'Option {o}' for o in range(options))
+        yield ".div"
+        yield f'.select name="s{s}" id="s{s}" :: {opts}'
+        yield "..div"
+        yield ".table"
+        yield ".tr"
+        yield f'.tdlabel for="t{s}" :: Select {s}'
+        yield f'.tdselect name="t{s}" id="t{s}" :: {opts}'
+        yield "..tr"
+        yield "..table"
+
+
+def checkbox_rows(lists: int, items: int) -> Iterator[str]:
+    """Long .rowslabelcheckbox lists"""
+    yield ".title Synthetic checkboxes"
+    for n in range(lists):
+        yield ".table"
+        yield f".rowslabelcheckbox {' // '.join(f'View {n}.{i} Wheel Turn' for i in range(items))}"
+        yield "..table"
+
+
+def write_lines(fn: str, lines) -> int:
+    count = 0
+    with open(fn, 'w') as ofd:
+        for ln in lines:
+            ofd.write(f"{ln}\n")
+            count += 1
+    return count
+
+
+def include_tree(dirpath: str, depth: int, fanout: int, leaf_rows: int = 20) -> str:
+    """Write a tree of files, each !including fanout children, depth levels deep; returns the root's path"""
+    def write(level: int, name: str) -> str:
+        fn = os.path.join(dirpath, f"{name}.hroff")
+        lines = [ ".table", ".tr" ]
+        if level < depth:
+            for k in range(fanout):
+                child = write(level + 1, f"{name}_{k}")
+                lines += [ ".td", f"!include {os.path.basename(child)}", "..td" ]
+        else:
+            lines += [ f".td {name} // {r} // leaf" for r in range(leaf_rows) ]
+        lines += [ "..tr", "..table" ]
+        write_lines(fn, lines)
+        return fn
+    root = write(0, "node")
+    fn = os.path.join(dirpath, "tree.hroff")
+    write_lines(fn, [ ".title Synthetic include tree", f"!include {os.path.basename(root)}" ] +
+                    [ f"!fragment {os.path.basename(root)}" ])
+    return fn
+
+
+# name -> writer(dirpath, scale) returning the page to render; scale=1 is the default benchmark size;
+CASES = dict(
+    samples=lambda d, scale: _write(d, 'samples', scaled_samples(100 * scale)),
+    tables=lambda d, scale: _write(d, 'tables', table_rows(20000 * scale)),
+    selects=lambda d, scale: _write(d, 'selects', select_options(20 * scale, 2000)),
+    checkboxes=lambda d, scale: _write(d, 'checkboxes', checkbox_rows(200 * scale, 100)),
+    includes=lambda d, scale: include_tree(d, depth=4 + scale, fanout=4),
+)
+
+
+def _write(dirpath: str, name: str, lines) -> str:
+    fn = os.path.join(dirpath, f"{name}.hroff")
+    write_lines(fn, lines)
+    return fn
@@ -4,24 +4,36 @@ hroff -- a lightweight file to generate HTML for markups, etc.;
 """
 
 if True:
+    # Keep this list short: it's paid on every run (check with python -X importtime -m hroff);
     from   collections import OrderedDict
-    import datetime
     import os
-    from   pprint import pprint
     import re
+    import stat
     import sys
-    from   typing import AnyStr, Dict, List, NoReturn
+    import time
+    from   typing import AnyStr, Dict, Iterator, List, NoReturn
 
 
-class Components(dict):
+class Components():
+    """One parsed input line, as a compact token
+
+    Everything is parsed once, up front, into slots.  After that only parse_subterms() re-parses a token in
+    place (besides the lazily filled _cache), so callers that re-parse a token rendered more than once do it on
+    a copy().  There is no __setitem__; the slots are plain attributes only because a guarding __setattr__ costs
+    a third of the lexer's throughput.  The mapping methods (c['subterms'], c.get('name'), 'fields' in c,
+    c.items()) keep the old dict-style access working for existing callers.
+    """
+    __slots__ = ( 'line', 'type', 'name', 'atoms', 'args', 'argString', '_fields', '_subterms', '_cache' )
     CAN_RENDER = [ 'directive', 'end', 'hroff comment', 'html comment', 'test-start', 'text' ]
-    # These should probably be dispatch dicts;
+    # The tag tables; render and renderable look lines up in RENDERERS/RENDERABLE, built from these below;
     CAN_RENDER_START = [ 'div', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
                          'label', 'input', 'rowslabelcheckbox', 'select',
                          'table', 'tdcheckbox', 'tdinput', 'tdlabel', 'tdselect', 'textarea', 'tr' ]
     CAN_RENDER_ENCAPSULATED = [ 'div', 'td', 'th', 'tr' ]
     COMPLETE = [ 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'label', 'textarea' ]
     EXTENDED_RENDER = dict(select='option', tdselect='option')
+    KEYS = ( 'line', 'type', 'atoms', 'args', 'name', 'subterms', 'fields' ) # dict view, in the old key order;
+    LINE_TYPES = { '.': 'start', '!': 'directive', ';': 'hroff comment', '#': 'html comment', ',': 'continuation' }
     PREFACES = [ ';', '.', '#', '!', ',', '@' ]
     PARENT_PARTS = re.compile(r'\s*::\s*')
     SLASHED = re.compile(r'\s*//\s*')
@@ -29,35 +41,188 @@ class Components(dict):
     WORDS = re.compile(r'\s+')
 
     def __init__(self, ln: str, **kwa: dict) -> NoReturn:
-        self['line'] = ln
-        self['type'] = 'text'
-        self.parse(ln)
+        self.line = ln
+        self._cache = None          # Lazily built strings (withopts, options, ...);
+        if kwa and kwa.get('reference', False):
+            self._parse_reference(ln)
+        else:
+            self.parse(ln)
+
+    # dict-compatible view;
+    def __contains__(self, k) -> bool:
+        return self.get(k, None) is not None
+
+    def __getitem__(self, k):
+        v = self.get(k, None)
+        if v is None:
+            raise KeyError(k)
+        return v
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def __repr__(self) -> str:
+        return repr(self.as_dict())
+
+    def as_dict(self) -> Dict:
+        return { k: self.get(k, None) for k in self.keys() }
+
+    def get(self, k, default = None):
+        if k == 'subterms':
+            v = self.subterms
+        elif k == 'fields':
+            v = self._fields
+        elif k in Components.KEYS:
+            v = getattr(self, k)
+        else:
+            v = None
+        return default if v is None else v
+
+    def items(self) -> List:
+        return [ (k, self.get(k, None)) for k in self.keys() ]
+
+    def keys(self) -> List:
+        if self.atoms is None:
+            return [ 'line', 'type' ]
+        keys = [ 'line', 'type', 'atoms', 'args' ]
+        if self.name is not None and self.type in ( 'start', 'end' ):
+            keys.append('name')
+        keys.append('subterms')
+        if self._fields is not None:
+            keys.append('fields')
+        if self.name is not None and self.type not in ( 'start', 'end' ):
+            keys.append('name')
+        return keys
+
+    def values(self) -> List:
+        return [ self.get(k, None) for k in self.keys() ]
+
+    @property
+    def state(self) -> tuple:
+        """The parse as a tuple of builtins, for marshal (see from_state, and the AST cache)"""
+        return ( self.line, self.type, self.name, self.atoms, self.args, self.argString,
+                 self._fields, self._subterms )
+
+    @classmethod
+    def from_state(cls, state: tuple):
+        """Rebuild a token from its state without lexing the line again"""
+        self = cls.__new__(cls)
+        ( self.line, self.type, self.name, self.atoms, self.args, self.argString,
+          self._fields, self._subterms ) = state
+        self._cache = None
+        return self
 
     @staticmethod
     def atomize(ln: str):
-        return WORDS.split(ln)
+        return Components.WORDS.split(ln)
 
     def parse(self, ln: AnyStr, **kwa: dict) -> NoReturn:
-        """Parse an hroff input line into it's critical components"""
+        """Parse an hroff input line into it's critical components, in a single pass
+
+        One split into atoms; the prefix picks the line type, and '::'/'//' are located by counting atoms,
+        so the parent/child and field splits are plain str.split()s.  Lines where '::' or '//' is glued
+        onto a word (ie: a URL next to fields) go through _parse_reference, whose regexes define those.
+        """
+        if not ln:
+            self.type, self.name, self.atoms, self.args, self.argString = 'text', None, None, None, ""
+            self._fields = self._subterms = None
+            return
+        atoms = ln.split()          # == WORDS.split(ln), which also yields '' for outer whitespace;
+        if ln[0].isspace():
+            atoms.insert(0, '')
+        if ln[-1].isspace():
+            atoms.append('')
+        n_slashed, n_parent = atoms.count('//'), atoms.count('::')
+        if (n_slashed and ln.count('//') != n_slashed) or (n_parent and ln.count('::') != n_parent):
+            return self._parse_reference(ln)
+        self.atoms = atoms
+        a0 = atoms[0]
+        args = atoms[1:]
+        argString = " ".join(args)
+        if n_parent and ( a0 != '::' or n_parent > 1 ):
+            # .name opt=v opt=v :: kid // kid_opts :: kid // ...
+            parent_base, kid_base = argString.split('::', 1)
+            parent_base, kid_base = parent_base.rstrip(), kid_base.lstrip()
+            sep = args.index('::')
+            opts = " ".join([ word for word in args[:sep] if '=' in word ])
+            children = [ ]
+            for kid in Components._split_on(kid_base, '//'):
+                if '::' in kid:
+                    child_opt_str, child_arg_str = kid.split('::', 1)
+                    child_opt_str, child_arg_str = child_opt_str.rstrip(), child_arg_str.lstrip()
+                else:
+                    child_opt_str, child_arg_str = "", kid
+                children.append(dict(base=kid, opts=child_opt_str, args=child_arg_str))
+            self._subterms = dict(base=parent_base, opts=opts, children=children)
+            kid_args = args[sep + 1:]
+            kid_argString = " ".join(kid_args)
+        elif n_slashed and ( a0 != '//' or n_slashed > 1 ):
+            # .cmd a0 // a1 // a2 ...
+            children = [ dict(opts='', base=kid) for kid in Components._split_on(argString, '//') ]
+            self._subterms = dict(base=args, opts="", children=children)
+            kid_args, kid_argString = args, argString
+        else:
+            self._subterms = None   # None: the trivial dict(base=args, opts="", children=[]);
+            kid_args, kid_argString = args, argString
+        if n_slashed:
+            fields = Components._split_on(ln, '//')
+            mtch = Components.UNTYPE.match(fields[0])
+            if mtch:
+                fields[0] = mtch.groups()[-1]
+            self._fields = fields
+        else:
+            self._fields = None
+
+        type_ = Components.LINE_TYPES.get(ln[0], None)
+        if type_ is None:                   # text (and '@' lines);
+            self.type, self.name, self.args, self.argString = 'text', None, kid_args, kid_argString
+        elif type_ == 'start':
+            if a0.startswith('..'):
+                self.type, self.name = 'end', a0[2:]
+            else:
+                self.type, self.name = type_, a0[1:]
+            self.args, self.argString = kid_args, kid_argString
+        elif type_ == 'directive':
+            self.type, self.name, self.args, self.argString = type_, a0[1:], args, argString
+        else:                               # comments and continuations keep the raw text;
+            self.type, self.name, self.args, self.argString = type_, None, [ ln[1:] ], ln[1:]
+
+    @staticmethod
+    def _split_on(s: str, sep: str) -> List:
+        # Same as re.split(rf'\s*{sep}\s*', s): whitespace goes only where it touches a separator;
+        parts = s.split(sep)
+        if len(parts) == 1:
+            return parts
+        return [ parts[0].rstrip() ] + [ part.strip() for part in parts[1:-1] ] + [ parts[-1].lstrip() ]
+
+    def _parse_reference(self, ln: AnyStr) -> NoReturn:
+        # The original regex-per-step parser; the definition parse() has to agree with;
+        self.type, self.name, self.atoms, self.args, self.argString = 'text', None, None, None, ""
+        self._fields = self._subterms = None
         if not ln:
             # self.parse_subterms() # Shouldn't need this call for null lines;
             return
-        atoms = self['atoms'] = Components.WORDS.split(ln)
+        atoms = Components.WORDS.split(ln)
+        self.atoms = atoms
         a0 = atoms[0]
-        self['args'] = atoms[1:]
+        self.args = atoms[1:]
 
         if a0.startswith('.'):
-            self['type'] = 'start'
-            self['name'] = atoms[0][1:]
+            self.type = 'start'
+            self.name = atoms[0][1:]
             # if kwa('forgiving', False):
             #   if self.name.endswith('>'): self['name'] = self['name'][:-1]
         if a0.startswith('..'):
-            self['type'] = 'end'
-            self['name'] = atoms[0][2:]
+            self.type = 'end'
+            self.name = atoms[0][2:]
 
         self.parse_subterms()
         if '//' in atoms:
-            fields = self['fields'] = Components.SLASHED.split(ln)
+            fields = Components.SLASHED.split(ln)
+            self._fields = fields
             f0 = fields[0]
             mtch = Components.UNTYPE.match(f0)
             if mtch:
@@ -69,35 +234,41 @@ class Components(dict):
 
         # WORST PARSER EVER BELOW!
         # All these type strings should be enums tho...
-        if self['type'] in [ 'start', 'end' ]:
+        if self.type in [ 'start', 'end' ]:
             return
         elif atoms[0].startswith('!'):
-            self['type'] = 'directive'
-            self['name'] = atoms[0][1:]
-            self['args'] = atoms[1:]
+            self.type = 'directive'
+            self.name = atoms[0][1:]
+            self.args = atoms[1:]
         elif atoms[0].startswith(';'):
-            self['type'] = 'hroff comment'
-            self['args'] = [ ln[1:] ] # Shouldn't ever be seen, eh?
+            self.type = 'hroff comment'
+            self.args = [ ln[1:] ] # Shouldn't ever be seen, eh?
         elif atoms[0].startswith('#'):
-            self['type'] = 'html comment'
-            self['args'] = [ ln[1:] ]
+            self.type = 'html comment'
+            self.args = [ ln[1:] ]
         elif atoms[0].startswith(','):
-            self['type'] = 'continuation'
-            self['args'] = [ ln[1:] ]
+            self.type = 'continuation'
+            self.args = [ ln[1:] ]
+        else:
+            return
+        self.argString = " ".join(self.args)
         return
 
     def parse_subterms(self) -> NoReturn:
         args = self.args
-        self['subterms'] = dict(base=args, opts="", children=[])
+        argString = " ".join(args)
+        self.argString = argString
+        self._subterms = None
+        self._cache = None
 
         # Handle baseline expressions;
         # This isn't handling .select v0=k0 v1=k1 :: x // y // z (which should be obvious from if/elif terms);
         if ( "::" not in args) and ( "//" not in args ): # Does this handle case of non-fields but args for top level?
             return
         elif "::" in args:
-            parent_base, kid_base = Components.PARENT_PARTS.split(self.argString, 1)
+            parent_base, kid_base = Components.PARENT_PARTS.split(argString, 1)
             opts = " ".join([word for word in Components.WORDS.split(parent_base) if '=' in word])
-            self['subterms'] = dict(base=parent_base, opts=opts)
+            subterms = dict(base=parent_base, opts=opts)
             children = [ ]
             kids = Components.SLASHED.split(kid_base)
             # kid is a string, child is a dict;
@@ -107,24 +278,44 @@ class Components(dict):
                 else:
                     child_opt_str, child_arg_str = "", kid
                 children.append(dict(base=kid, opts=child_opt_str, args=child_arg_str))
-            self['subterms']['children'] = children
+            subterms['children'] = children
+            self._subterms = subterms
             # Evil bit here: Should remove opts from args and '::'
-            sep = self['args'].index('::') + 1
-            self['args'] = self['args'][sep:]
+            sep = args.index('::') + 1
+            self.args = args[sep:]
+            self.argString = " ".join(self.args)
             return
         elif '//' in args: # .cmd a0 // a1 // a2 ...
-            kid_fields = Components.SLASHED.split(self.argString)
+            kid_fields = Components.SLASHED.split(argString)
             children = [ ]
             for kid in kid_fields:
                 child = dict(opts='', base=kid) # FIX: Doesn't support child_opts :: words!
                 children.append(child)
-            self['subterms']['children'] = children
+            self._subterms = dict(base=args, opts="", children=children)
             return
         else:
             # Need to add children[0] args?
             return
         return
 
+    def copy(self) -> 'Components':
+        """A shallow copy, to re-parse without changing a token that's rendered more than once"""
+        other = Components.__new__(Components)
+        for k in Components.__slots__:
+            setattr(other, k, getattr(self, k, None))
+        other._cache = None
+        return other
+
+    def _cached(self, k: str, make):
+        cache = self._cache
+        if cache is None:
+            cache = { }
+            self._cache = cache
+        elif k in cache:
+            return cache[k]
+        v = cache[k] = make()
+        return v
+
     def _render_encapsulated(self):
         # parse subterms;
         nm, argString, fields = self.name, self.argString, self.fields
@@ -144,7 +335,7 @@ class Components(dict):
             return [ ] 
         inner_tag = Components.EXTENDED_RENDER[outer_tag]
         olist = [ ]
-        subterms = self['subterms']
+        subterms = self.subterms
         olist.append(f"<{outer_tag} {subterms['opts']}>")
         for child in subterms['children']:
             olist.append(f"<{inner_tag} {child['opts']}>{child['args']}</{inner_tag}>")
@@ -152,31 +343,28 @@ class Components(dict):
         return olist
 
     def _render_rowslabelcheckbox(self) -> List:
-        children = self['subterms'].get('children', [])
+        children = self.subterms.get('children', [])
         olist = [ ]
         ckbox = '<input type="checkbox">'
         for child in children:
             olist.append(f"<tr><td>{child['base']}</td><td>{ckbox}</td></tr>")
         return olist # f"<!-- {olist} -->"
 
-    @property
-    def args(self) -> List:
-        return self.get('args', None)
-
-    @property
-    def argString(self) -> AnyStr:
-        return " ".join(self.args)
+    def _complete_as(self, nm: AnyStr) -> AnyStr:
+        if self.argString:
+            return f"{self._withopts_as(nm)}{self.argString}</{nm}>"
+        else:
+            return f"{self._withopts_as(nm)}"
 
-    @property
-    def atoms(self) -> List:
-        return self.get('atoms', None)
+    def _withopts_as(self, nm: AnyStr) -> AnyStr:
+        opts = self.opts
+        if opts:
+            return f"<{nm} {opts}>"
+        return f"<{nm}>"
 
     @property
     def complete(self):
-        if self.argString:
-            return f"{self.withopts}{self.argString}{self.end}"
-        else:
-            return f"{self.withopts}"
+        return self._complete_as(self.name)
     
     @property
     def end(self):
@@ -185,124 +373,447 @@ class Components(dict):
     @property
     def fields(self) -> List:
         # The ambiguity introduced below (evil hack!) needs to be resolved;
-        return self.get('fields', self.get('args', None)) # Wonder what this will screw up?
-
-    @property
-    def line(self) -> AnyStr:
-        return self.get('line', None)
-    
-    @property
-    def name(self) -> AnyStr:
-        return self.get('name', None)
+        fields = self._fields
+        return self.args if fields is None else fields # Wonder what this will screw up?
 
     @property
     def optionless(self) -> List:
-        optionless = [ arg for arg in self.args if '=' not in arg ]
-        return optionless
+        return self._cached('optionless', lambda: [ arg for arg in self.args if '=' not in arg ])
     
     @property
     def options(self) -> List:
-        options = [ opt for opt in self.args if '=' in opt ]
-        return options
+        return self._cached('options', lambda: [ opt for opt in self.args if '=' in opt ])
+
+    @property
+    def opts(self) -> AnyStr:
+        subterms = self._subterms
+        return "" if subterms is None else subterms['opts']
 
     @property
     def render(self) -> AnyStr:
         """Simple Renderer for simple cases"""
         # In over 35 years of OOP, I have never written this function (render), which has appeared as a contrived
         # example in so many texts (even though I'm writing it as a property);
-        # Replace the following with match once we are using >=3.10;
-        type_ = self.type
-        if type_ == 'directive':
-            return ""
-        if type_ == 'end':
-            return f"</{self.name}>"
-        if type_ == 'hroff comment':
-            return ""
-        if type_ == 'html comment':
-            return f"<!-- {self.line[1:].strip()} -->"
-        if type_ == 'text':
-            return self.line
-        if type_ == 'start':
-            nm = self['name']
-            if nm in Components.CAN_RENDER_ENCAPSULATED:
-                return self._render_encapsulated()
-            if nm not in Components.CAN_RENDER_START:
-                return f'<!-- not in CAN_RENDER_START: {repr(self)} -->'
-            # if nm in [ 'table', ... ]: return self.withopts
-            if nm in Components.COMPLETE:
-                return self.complete
-            if nm == 'input':
-                s = f"{self.withopts}"
-                return s
-            if nm == 'select':
-                olist = self.render_nested('select')
-                return "\n".join(olist)
-            if nm == 'table':
-                return f'{self.withopts}'
-            if nm == 'tdcheckbox':
-                opts = self['subterms'].get('opts', "")
-                if opts:
-                    s = f'<td {opts}><input type="checkbox"></td>'
-                else:
-                    s = '<td><input type="checkbox"></td>'
-                return s                
-            if nm == 'tdinput':
-                self['name'] = 'input'
-                s = f"<td>{self.withopts}</td>"
-                return s
-            if nm == 'tdselect':
-                ostr = '\n'.join(self.render_nested('select'))
-                s = f"<td>{ostr}</td>"
-                return s
-            if nm == 'tdlabel':
-                self['name'] = 'label'
-                s = f"<td>{self.complete}</td>"
-                return s
-            if nm == 'rowslabelcheckbox':
-                return self._render_rowslabelcheckbox()
-            return f"<!-- Unknown start type {nm} -->"
-        if type_ == 'test':
-            # start_method, *args = self.determine_complexity()
-            # rs = start_method(*args) # ie: render_nested(outer, inner)
-            # return rs
-            if self.name == 'select':
-                return self.render_nested('select')
-            return ""
-        return f"<!-- unsuppored type {type_} -->"
+        renderer = Components.RENDERERS.get(( self.type, self.name ), None)
+        if renderer is None:
+            renderer = Components.RENDERERS.get(( self.type, None ), Components._render_unsupported)
+        return renderer(self)
 
     @property
     def renderable(self) -> bool:
-        nm, type_ = self.name, self.type
-        renderable = (type_ == 'start') and (nm in Components.CAN_RENDER_START)
-        renderable |= (type_ == 'start') and (nm in Components.CAN_RENDER_ENCAPSULATED)
-        renderable |= (type_ == 'end')
-        renderable |= (type_ == 'text')
-        renderable |= (type_ == 'html comment')
-        return renderable
+        """Whether render is this line's whole output (otherwise an HROFFFile handler has more to do)"""
+        type_ = self.type
+        return ( type_, self.name ) in Components.RENDERABLE or ( type_, None ) in Components.RENDERABLE
+
+    # Renderers, by line type and then by start tag; see RENDERERS below the class;
+    def _render_nothing(self) -> AnyStr:
+        return ""
+
+    def _render_end(self) -> AnyStr:
+        return f"</{self.name}>"
+
+    def _render_html_comment(self) -> AnyStr:
+        return f"<!-- {self.line[1:].strip()} -->"
+
+    def _render_text(self) -> AnyStr:
+        return self.line
+
+    def _render_not_start(self) -> AnyStr:
+        return f'<!-- not in CAN_RENDER_START: {repr(self)} -->'
+
+    def _render_test(self) -> List:
+        return self.render_nested('select')
+
+    def _render_unsupported(self) -> AnyStr:
+        return f"<!-- unsuppored type {self.type} -->"
+
+    def _render_complete(self) -> AnyStr:
+        return self.complete
+
+    def _render_withopts(self) -> AnyStr:
+        return f"{self.withopts}"
+
+    def _render_select(self) -> AnyStr:
+        return "\n".join(self.render_nested('select'))
+
+    def _render_tdcheckbox(self) -> AnyStr:
+        opts = self.opts
+        if opts:
+            return f'<td {opts}><input type="checkbox"></td>'
+        return '<td><input type="checkbox"></td>'
+
+    def _render_tdinput(self) -> AnyStr:
+        return f"<td>{self._withopts_as('input')}</td>"
+
+    def _render_tdselect(self) -> AnyStr:
+        ostr = '\n'.join(self.render_nested('select'))
+        return f"<td>{ostr}</td>"
+
+    def _render_tdlabel(self) -> AnyStr:
+        return f"<td>{self._complete_as('label')}</td>"
 
     @property
     def start(self):
         return f"<{self.name}>"
-    
+
     @property
-    def type(self) -> AnyStr:
-        return self.get('type', None)
+    def subterms(self) -> Dict:
+        if self.atoms is None:
+            return None
+        subterms = self._subterms
+        if subterms is None:
+            return dict(base=self.args, opts="", children=[ ])
+        return subterms
 
     @property
     def withopts(self):
-        if not 'subterms' in self:
-            self.parse_subterms()
-        if self['subterms']['opts']:
-            return f"<{self.name} {self['subterms']['opts']}>"
-        return f"<{self.name}>"
-    
-    
+        return self._cached('withopts', lambda: self._withopts_as(self.name))
+
+
+# ( line type, tag name ) -> renderer(components), with ( line type, None ) the fallback for a type, so finding a
+# line's renderer is a dict lookup or two however many tags there are.  RENDERABLE are the keys whose render is the
+# line's whole output.  register_tag() adds to both;
+Components.RENDERERS = { ( 'start', nm ): Components._render_complete for nm in Components.COMPLETE }
+Components.RENDERERS.update({ ( 'start', nm ): renderer for nm, renderer in dict(
+    input=Components._render_withopts, select=Components._render_select, table=Components._render_withopts,
+    tdcheckbox=Components._render_tdcheckbox, tdinput=Components._render_tdinput,
+    tdselect=Components._render_tdselect, tdlabel=Components._render_tdlabel,
+    rowslabelcheckbox=Components._render_rowslabelcheckbox).items() })
+Components.RENDERERS.update({ ( 'start', nm ): Components._render_encapsulated
+                              for nm in Components.CAN_RENDER_ENCAPSULATED })
+Components.RENDERERS.update({ ( 'start', None ): Components._render_not_start,
+                              ( 'end', None ): Components._render_end,
+                              ( 'html comment', None ): Components._render_html_comment,
+                              ( 'text', None ): Components._render_text,
+                              ( 'directive', None ): Components._render_nothing,
+                              ( 'hroff comment', None ): Components._render_nothing,
+                              ( 'test', 'select' ): Components._render_test,
+                              ( 'test', None ): Components._render_nothing })
+Components.RENDERABLE = { ( 'start', nm ) for nm in Components.CAN_RENDER_START + Components.CAN_RENDER_ENCAPSULATED }
+Components.RENDERABLE |= { ( 'end', None ), ( 'text', None ), ( 'html comment', None ) }
+
+
+class RenderStats():
+    """Opt-in instrumentation: HROFFFile(fn, stats=RenderStats()) then as_dict()/to_json()
+
+    Counts and cumulative seconds per line type and element/directive name, time per phase (load, parse,
+    render, save), include/fragment file I/O (from SOURCE_CACHE), and with memory=True the tracemalloc peak.
+    Without stats= nothing is timed; the instrumented methods are only bound onto instances that ask.
+    """
+    PHASES = ( 'load', 'parse', 'render', 'save' )
+
+    def __init__(self, memory: bool = False) -> NoReturn:
+        self._by_type = { }     # type -> { name -> [ count, seconds ] }
+        self._phases = dict.fromkeys(RenderStats.PHASES, 0.0)
+        self._cache_start = SOURCE_CACHE.stats()
+        self._cache = None
+        self._peak = None
+        self._tracing = False
+        if memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracing = True
+            tracemalloc.reset_peak()
+
+    def add(self, type_: str, name: str, seconds: float) -> NoReturn:
+        names = self._by_type.get(type_, None)
+        if names is None:
+            names = self._by_type[type_] = { }
+        entry = names.get(name, None)
+        if entry is None:
+            names[name] = [ 1, seconds ]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+    def phase(self, name: str, seconds: float) -> NoReturn:
+        self._phases[name] = self._phases.get(name, 0.0) + seconds
+
+    def seconds(self, phase: str) -> float:
+        return self._phases.get(phase, 0.0)
+
+    def finish(self) -> NoReturn:
+        """Snapshot the cache counters and memory peak (and stop tracemalloc if we started it)"""
+        cache = SOURCE_CACHE.stats()
+        self._cache = { k: v - self._cache_start.get(k, 0) for k, v in cache.items() if k not in ( 'entries', 'bytes' ) }
+        import tracemalloc
+        if tracemalloc.is_tracing():
+            self._peak = tracemalloc.get_traced_memory()[1]
+            if self._tracing:
+                tracemalloc.stop()
+                self._tracing = False
+
+    def as_dict(self) -> Dict:
+        if self._cache is None:
+            self.finish()
+        by_type = { type_: { name: dict(count=count, seconds=seconds) for name, (count, seconds) in names.items() }
+                    for type_, names in self._by_type.items() }
+        include_io = dict(reads=self._cache['io_reads'], bytes=self._cache['io_bytes'],
+                          seconds=self._cache['io_seconds'])
+        return dict(phases=dict(self._phases), by_type=by_type, include_io=include_io, cache=self._cache,
+                    peak_memory_bytes=self._peak)
+
+    def to_json(self) -> str:
+        import json
+        return json.dumps(self.as_dict(), indent=1, sort_keys=True)
+
+    @staticmethod
+    def merge(stats: List[Dict]) -> Dict:
+        """Sum as_dict() results (ie: from batch workers); peak memory is the largest"""
+        merged = dict(phases={ }, by_type={ }, include_io={ }, cache={ }, peak_memory_bytes=None)
+        for each in stats:
+            for k in ( 'phases', 'include_io', 'cache' ):
+                for name, v in each[k].items():
+                    merged[k][name] = merged[k].get(name, 0) + v
+            for type_, names in each['by_type'].items():
+                into = merged['by_type'].setdefault(type_, { })
+                for name, entry in names.items():
+                    total = into.setdefault(name, dict(count=0, seconds=0.0))
+                    total['count'] += entry['count']
+                    total['seconds'] += entry['seconds']
+            if each['peak_memory_bytes'] is not None:
+                merged['peak_memory_bytes'] = max(merged['peak_memory_bytes'] or 0, each['peak_memory_bytes'])
+        return merged
+
+
+class SourceCache():
+    """Process-wide LRU of fragment lines and rendered include output
+
+    Entries are keyed by real path and re-validated against mtime/size on every lookup, so an edited
+    file is re-read rather than served stale; the cache is bounded by entry count and (approximate) bytes.
+    """
+    def __init__(self, maxsize: int = 512, maxbytes: int = 64 << 20) -> NoReturn:
+        import threading
+        self._maxsize = maxsize
+        self._maxbytes = maxbytes
+        self._entries = OrderedDict()   # realpath -> dict(stamp, lines, rendered, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = dict(hits=0, misses=0, render_hits=0, render_misses=0, evictions=0, prefetches=0,
+                              io_reads=0, io_bytes=0, io_seconds=0.0)
+        if hasattr(os, 'register_at_fork'):
+            # A prefetch thread left reading past its timeout may hold the lock; a child forked then (chunk
+            # workers, batch pools) would wait on it for ever, so fork waits for it instead;
+            os.register_at_fork(before=self._lock.acquire, after_in_parent=self._lock.release,
+                                after_in_child=self._lock.release)
+
+    @staticmethod
+    def _stat(fn: str) -> tuple:
+        key = os.path.realpath(fn)
+        st = os.stat(key)
+        return key, (st.st_mtime_ns, st.st_size)
+
+    def _entry(self, fn: str, known: tuple = None) -> Dict:
+        # Caller holds the lock; known is fn's ( real path, stamp ), if a FileLookups has it already;
+        key, stamp = known or SourceCache._stat(fn)
+        entry = self._entries.get(key, None)
+        if entry is not None and entry['stamp'] == stamp:
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return entry
+        self._counters['misses'] += 1
+        t0 = time.perf_counter()
+        lines = list(MappedLines(key, rstrip=True)) # Dont use strip, preserve indents
+        return self._store(key, stamp, lines, stamp[1], time.perf_counter() - t0)
+
+    def _store(self, key: str, stamp: tuple, lines: List, size: int, seconds: float) -> Dict:
+        # Caller holds the lock;
+        self._counters['io_seconds'] += seconds
+        self._counters['io_reads'] += 1
+        self._counters['io_bytes'] += size
+        if key in self._entries:
+            self._forget(key)
+        entry = dict(stamp=stamp, lines=lines, rendered={ }, size=size)
+        self._entries[key] = entry
+        self._bytes += entry['size']
+        self._evict()
+        return entry
+
+    def warm(self, fn: str, known: tuple = None) -> List:
+        """lines(fn), read without holding the cache's lock, so that several threads can load files at once"""
+        key, stamp = known or SourceCache._stat(fn)
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and entry['stamp'] == stamp:
+                return entry['lines']
+        t0 = time.perf_counter()
+        lines = list(MappedLines(key, rstrip=True))
+        seconds = time.perf_counter() - t0
+        with self._lock:
+            self._counters['prefetches'] += 1
+            entry = self._entries.get(key, None)
+            if entry is not None and entry['stamp'] == stamp:
+                return entry['lines']   # Another thread got there first;
+            return self._store(key, stamp, lines, stamp[1], seconds)['lines']
+
+    def _evict(self) -> NoReturn:
+        while len(self._entries) > 1 and (len(self._entries) > self._maxsize or self._bytes > self._maxbytes):
+            key = next(iter(self._entries))
+            self._forget(key)
+            self._counters['evictions'] += 1
+
+    def _forget(self, key: str) -> NoReturn:
+        entry = self._entries.pop(key)
+        self._bytes -= entry['size']
+
+    def clear(self) -> NoReturn:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            for k in self._counters:
+                self._counters[k] = type(self._counters[k])()
+
+    def lines(self, fn: str, known: tuple = None) -> List:
+        """Raw (rstripped) lines of fn; the list is shared, don't mutate it
+
+        known is fn's ( real path, (mtime_ns, size) ) from FileLookups.stat, to save looking them up again."""
+        with self._lock:
+            return self._entry(fn, known)['lines']
+
+    def rendered(self, fn: str, render, key = 'html', valid = None, known: tuple = None) -> List:
+        """render(lines) of fn, computed once per version of the file; the list is shared, don't mutate it
+
+        key names the kind of rendering, when the same file is rendered more than one way.  valid(rendering),
+        if given, also has to pass for a cached rendering to be reused (for renderings that read other files).
+        known is as for lines."""
+        with self._lock:
+            entry = self._entry(fn, known)
+            cached = entry['rendered'].get(key, None)
+            lines = entry['lines']
+        if cached is not None and (valid is None or valid(cached)):
+            with self._lock:
+                self._counters['render_hits'] += 1
+            return cached
+        rendered = render(lines)
+        with self._lock:
+            self._counters['render_misses'] += 1
+            if entry is self._entries.get(known[0] if known else os.path.realpath(fn), None):
+                size = SourceCache._weigh(rendered)
+                if key in entry['rendered']:
+                    size -= SourceCache._weigh(entry['rendered'][key])
+                entry['rendered'][key] = rendered
+                entry['size'] += size
+                self._bytes += size
+                self._evict()
+        return rendered
+
+    @staticmethod
+    def _weigh(rendering) -> int:
+        # Approximate bytes: the lines (the first item, when a rendering carries more than its lines);
+        lines = rendering[0] if type(rendering) == tuple else rendering
+        return sum(len(ln) for ln in lines)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return dict(self._counters, entries=len(self._entries), bytes=self._bytes)
+
+
+SOURCE_CACHE = SourceCache()
+
+
+class FileLookups():
+    """One build's lookups: each path is stat'd, and its real path taken, once however often it's named
+
+    Prefetch threads fill it and the render reuses what they found.  A build sees a file as it was at its first
+    lookup; SOURCE_CACHE re-validates across builds, each of which has its own FileLookups."""
+    def __init__(self) -> NoReturn:
+        self._files = { }   # path -> ( real path, (mtime_ns, size) ), None if it isn't a file
+
+    def stat(self, fn: str) -> tuple:
+        known = self._files.get(fn, False)
+        if known is False:
+            try:
+                st = os.stat(fn)
+                known = ( os.path.realpath(fn), (st.st_mtime_ns, st.st_size) ) if stat.S_ISREG(st.st_mode) else None
+            except OSError:
+                known = None
+            known = self._files.setdefault(fn, known)
+            if known is not None:
+                self._files.setdefault(known[0], known)
+        return known
+
+    def isfile(self, fn: str) -> bool:
+        return self.stat(fn) is not None
+
+    def locate(self, name: str, parent: str) -> str:
+        # Nested includes are looked for beside the file that includes them first;
+        for fn in ( os.path.join(parent, name), name ):
+            if self.stat(fn) is not None:
+                return fn
+        return None
+
+
+class MappedLines():
+    """The lines of a file, read lazily through mmap; each iteration maps the file afresh
+
+    The map is split into lines a block at a time, so memory stays at about BLOCK however big the file is.
+    Lines lose their "\n" or "\r\n" (a last line without one loses nothing), and with skip_comments lines
+    starting with ';' are dropped before they are decoded.  start/stop limit reading to a byte range, which
+    should begin at the start of a line and end just after a newline (or at the end of the file).
+    """
+    BLOCK = 1 << 20
+
+    def __init__(self, fn: str, skip_comments: bool = False, rstrip: bool = False,
+                 start: int = 0, stop: int = None) -> NoReturn:
+        self._fn = fn
+        self._skip_comments = skip_comments
+        self._rstrip = rstrip
+        self._start = start
+        self._stop = stop
+
+    def __iter__(self) -> Iterator[str]:
+        import mmap
+        with open(self._fn, 'rb') as ifd:
+            if os.fstat(ifd.fileno()).st_size == 0:
+                return
+            mm = mmap.mmap(ifd.fileno(), 0, access=mmap.ACCESS_READ)
+        with mm:
+            # Pages already split into lines are handed back, or a big file would end up all resident;
+            release = getattr(mmap, 'MADV_DONTNEED', None) if hasattr(mm, 'madvise') else None
+            if release is not None:
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            pos = self._start
+            end = len(mm) if self._stop is None else min(self._stop, len(mm))
+            if end <= pos:
+                return
+            released = pos - pos % mmap.PAGESIZE
+            if mm[end - 1] == 10:   # A final newline ends the last line rather than starting another;
+                end -= 1
+            while True:
+                stop = pos + MappedLines.BLOCK
+                if stop >= end:
+                    stop = end
+                else:
+                    nl = mm.rfind(b'\n', pos, stop)
+                    if nl < 0:      # One line longer than a block;
+                        nl = mm.find(b'\n', stop, end)
+                    stop = end if nl < 0 else nl
+                block = mm[pos:stop]
+                if release is not None and stop - released >= MappedLines.BLOCK:
+                    done = stop - stop % mmap.PAGESIZE
+                    mm.madvise(release, released, done - released)
+                    released = done
+                yield from self._lines(block)
+                if stop >= end:
+                    break
+                pos = stop + 1
+
+    def _lines(self, block: bytes) -> Iterator[str]:
+        crlf = b'\r' in block
+        for raw in block.split(b'\n'):
+            if self._skip_comments and raw[:1] == b';':
+                continue
+            if crlf and raw[-1:] == b'\r':
+                raw = raw[:-1]
+            ln = raw.decode('utf-8')
+            yield ln.rstrip() if self._rstrip else ln
+
+
 class Fragment():
-    def __init__(self, fn):
+    def __init__(self, fn, known: tuple = None):
         self._fn = fn
-        ifd = open(fn, 'r')
-        self._ibuf = [ln.rstrip() for ln in ifd.readlines()] # Dont use strip, preserve indents
-        ifd.close()
+        self._ibuf = SOURCE_CACHE.lines(fn, known)
 
     def __str__(self):
         return self.str
@@ -319,10 +830,26 @@ class Fragment():
     def str(self):
         return "\n".join(self._ibuf)
 
+MAX_INCLUDE_DEPTH = 32
+
+
 class Include(Fragment):
-    def __init__(self, fn):
-        super(Include, self).__init__(fn)
+    """An !include: the file's lines rendered, with its own !include/!fragment lines expanded in place
+
+    Includes nest to any depth up to MAX_INCLUDE_DEPTH; a file that includes itself, directly or not, is an error.
+    Each file is expanded once per build (memo, keyed by real path, or by name with a resolver) and, across
+    builds, once per version of it and everything under it (SOURCE_CACHE), so a library referenced from many
+    places costs its number of distinct files.
+    """
+    def __init__(self, fn, memo: Dict = None):
+        # Lines are only pulled from SOURCE_CACHE on demand; render usually never needs them;
+        self._fn = fn
         self._obuf = [ ]
+        self._memo = { } if memo is None else memo
+
+    @property
+    def _ibuf(self) -> List:
+        return SOURCE_CACHE.lines(self._fn)
 
     def __str__(self):
         return self.str
@@ -337,10 +864,101 @@ class Include(Fragment):
 
     @property
     def render(self) -> List:
-        obuf = [ ]
-        for ln in self._ibuf:
+        return Include.expand(self._fn, self._memo)[0]
+
+    @staticmethod
+    def expand(fn: str, memo: Dict, chain: tuple = ( ), resolver = None, lines: List = None,
+               lookups: 'FileLookups' = None) -> tuple:
+        """( html lines, files under fn, depth, keys, stamps ) for fn, included below chain (keys of the includers)
+
+        With a resolver, fn and everything under it come from resolver(name, directive) (lines may be fn's, if
+        already fetched) rather than from disk, and are memoized for the build only.  lookups is the build's
+        FileLookups, shared with the page (and its prefetch), so no file is located or stat'd twice."""
+        lookups = FileLookups() if lookups is None else lookups
+        known = None if resolver is not None else lookups.stat(fn)
+        key = fn if resolver is not None else known[0] if known else os.path.realpath(fn)
+        if key in chain:
+            raise RuntimeError(f"!include cycle: {' -> '.join(chain[chain.index(key):] + ( key, ))}")
+        if len(chain) >= MAX_INCLUDE_DEPTH:
+            raise RuntimeError(f"!include nested deeper than {MAX_INCLUDE_DEPTH}: {' -> '.join(chain + ( key, ))}")
+        below = chain + ( key, )
+        tree = memo.get(key, None)
+        if tree is None:
+            if resolver is not None:
+                if lines is None:
+                    lines = Include._resolve(resolver, fn, 'include')
+                tree = Include._expand_lines(fn, lines, memo, below, resolver, lookups)
+            else:
+                # Per working directory: names are also looked for relative to it, and deps are relative paths;
+                tree = SOURCE_CACHE.rendered(
+                    fn, lambda lines: Include._expand_lines(fn, lines, memo, below, None, lookups),
+                    key=( 'include', os.getcwd() ), known=known, valid=lambda tree: Include._unchanged(tree, lookups))
+            memo[key] = tree
+        if len(below) + tree[2] > MAX_INCLUDE_DEPTH or any(k in chain for k in tree[3]):
+            # Expanded under another chain (earlier, or for another page); doing it again here raises the error;
+            fresh = Include._resolve(resolver, fn, 'include') if resolver is not None else SOURCE_CACHE.lines(fn, known)
+            Include._expand_lines(fn, fresh, { }, below, resolver, lookups)
+        return tree
+
+    @staticmethod
+    def _resolve(resolver, name: str, directive: str) -> List:
+        lines = resolver(name, directive)
+        if lines is None:
+            return None
+        return [ ln.rstrip() for ln in (lines.splitlines() if isinstance(lines, str) else lines) ]
+
+    @staticmethod
+    def _unchanged(tree: tuple, lookups: 'FileLookups') -> bool:
+        # A None stamp is a file that was looked for and missing; it has to still be;
+        for fn, stamp in tree[4]:
+            known = lookups.stat(fn)
+            if (known[1] if known else None) != stamp:
+                return False
+        return True
+
+    @staticmethod
+    def _expand_lines(fn: str, lines: List, memo: Dict, chain: tuple, resolver, lookups: 'FileLookups') -> tuple:
+        obuf, deps, keys, stamps, depth = [ ], [ ], [ ], [ ], 0
+        parent = os.path.dirname(fn)
+        for ln in lines:
             if not ln:
                 continue
+            if ln.startswith('!include') or ln.startswith('!fragment'):
+                fields = Components.WORDS.split(ln)
+                directive = fields[0][1:]
+                if directive in ( 'include', 'fragment' ):
+                    name = fields[-1] if len(fields) > 1 else ""
+                    if resolver is not None:
+                        found = Include._resolve(resolver, name, directive) if name else None
+                        path = name
+                    else:
+                        path = lookups.locate(name, parent) if name else None
+                        found = path
+                    if found is None:
+                        obuf.append(f"<!-- WARNING: No such {directive} file {name}: {ln} -->")
+                        if resolver is None and name:   # Stale (here and for pages above) once it turns up;
+                            for path in dict.fromkeys(( os.path.join(parent, name), name )):
+                                deps.append(path)
+                                stamps.append(( os.path.abspath(path), None ))
+                        continue
+                    deps.append(path)
+                    if resolver is None:
+                        known = lookups.stat(path)
+                        keys.append(known[0])
+                        stamps.append(known)
+                    else:
+                        keys.append(path)
+                    if directive == 'fragment':
+                        obuf += found if resolver is not None else SOURCE_CACHE.lines(path, known)
+                        continue
+                    html, sub_deps, sub_depth, sub_keys, sub_stamps = Include.expand(
+                        path, memo, chain, resolver, found if resolver is not None else None, lookups)
+                    obuf += html
+                    deps += sub_deps
+                    keys += sub_keys
+                    stamps += sub_stamps
+                    depth = max(depth, sub_depth + 1)
+                    continue
             components = Components(ln)
             html = components.render
             html_type = type(html)
@@ -351,39 +969,456 @@ class Include(Fragment):
                 obuf.append(html)
             else:
                 obuf.append(f"<!-- Include.render: bad type {html_type} in  {html}")
-        return obuf
+        return obuf, list(dict.fromkeys(deps)), depth, list(dict.fromkeys(keys)), list(dict.fromkeys(stamps))
 
     @property
     def str(self) -> str:
         return "\n".join(self._obuf)
 
 
+# Strings pass through untouched; comments go; whitespace around punctuation goes; other runs become one space;
+CSS_TOKENS = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|/\*.*?\*/|\s*([{};,>])\s*|:\s+|\s+', re.S)
+
+
+def minify_asset(lines: List, kind: str) -> List:
+    """Whitespace-only minification of css (to one line) or js (lines trimmed, blank and // lines dropped)"""
+    if kind == 'css':
+        def squeeze(m):
+            if m.group(1) or m.group(2):
+                return m.group(1) or m.group(2)
+            token = m.group(0)
+            return '' if token.startswith('/*') else ':' if token.startswith(':') else ' '
+        return [ CSS_TOKENS.sub(squeeze, "\n".join(lines)).strip() ]
+    # Newlines stay, so automatic semicolon insertion still sees the same statements;
+    trimmed = ( ln.strip() for ln in lines )
+    return [ ln for ln in trimmed if ln and not ln.startswith('//') ]
+
+
+def fingerprinted(href: str, lines: List) -> str:
+    """href with a hash of the asset's content before the extension: css/site.css -> css/site.0123456789.css"""
+    import hashlib
+    prefix, ext = os.path.splitext(href)
+    digest = hashlib.sha1("\n".join(lines).encode()).hexdigest()[:10]
+    return f"{prefix}.{digest}{ext}"
+
+
+TABLE_FORMATS = { '.csv': 'csv', '.tsv': 'tsv', '.tab': 'tsv', '.jsonl': 'jsonl', '.ndjson': 'jsonl' }
+
+
+def _json_cell(v) -> str:
+    import json
+    return v if isinstance(v, str) else "" if v is None else json.dumps(v)
+
+
+def table_data_rows(lines, fmt: str, header: bool = False, columns: List = None) -> Iterator[List]:
+    """Rows (lists of str) from csv/tsv/jsonl lines, read lazily; with header the first row is the column names
+
+    columns picks and orders columns, by name (from the header, or jsonl object keys) or 0-based index.
+    An unknown column raises ValueError here, before any row is read past the header."""
+    lines = iter(lines)
+    if fmt == 'jsonl':
+        import itertools, json
+        records = ( json.loads(ln) for ln in lines if ln.strip() )
+        first = next(records, None)
+        if first is None:
+            return iter(())
+        records = itertools.chain([ first ], records)
+        if isinstance(first, dict):
+            keys = list(columns) if columns else list(first)
+            rows = ( [ _json_cell(record.get(k, None)) for k in keys ] for record in records )
+            return itertools.chain([ keys ], rows) if header else rows
+        rows = ( [ _json_cell(v) for v in record ] for record in records )
+    elif fmt in ( 'csv', 'tsv' ):
+        import csv
+        rows = csv.reader(lines, delimiter='\t' if fmt == 'tsv' else ',')
+    else:
+        raise ValueError(f"unknown table format {fmt}")
+    names = next(rows, None) if header else None
+    if not columns:
+        return rows if names is None else _prepend(names, rows)
+    picks = [ ]
+    for column in columns:
+        if column.isdigit():
+            picks.append(int(column))
+        elif names is not None and column in names:
+            picks.append(names.index(column))
+        else:
+            raise ValueError(f"no column {column}")
+    pick = lambda row: [ row[i] if i < len(row) else "" for i in picks ]
+    rows = ( pick(row) for row in rows )
+    return rows if names is None else _prepend(pick(names), rows)
+
+
+def _prepend(first, rest) -> Iterator:
+    yield first
+    yield from rest
+
+
+def table_data_html(rows, header: bool = False, escape: bool = False, batch: int = 1000) -> Iterator[str]:
+    """<tr> markup for rows, one string per batch of rows (lines joined by "\n", as the body is)"""
+    rows = iter(rows)
+    if escape:
+        from html import escape as quote
+        rows = ( [ quote(cell, quote=False) for cell in cells ] for cells in rows )
+    if header:
+        cells = next(rows, None)
+        if cells is not None:
+            yield "\n".join([ "<tr>", *( f"    <th>{cell}</th>" for cell in cells ), "</tr>" ])
+    out = [ ]
+    for cells in rows:
+        if not cells:   # Blank lines in csv/tsv;
+            continue
+        out.append("<tr>\n    <td>" + "</td>\n    <td>".join(cells) + "</td>\n</tr>")
+        if len(out) >= batch:
+            yield "\n".join(out)
+            out = [ ]
+    if out:
+        yield "\n".join(out)
+
+
+RAW_OPEN = re.compile(r'<(pre|textarea)\b', re.I)
+RAW_CLOSE = re.compile(r'</(pre|textarea)\s*>', re.I)
+
+
+def minify_html(html) -> Iterator[str]:
+    """Whitespace-only minification of html lines: ends of lines trimmed, blank lines dropped
+
+    Line breaks stay (they're the whitespace between inline elements), and so does everything from a <pre> or
+    <textarea> to its closing tag."""
+    raw = False
+    for ln in html:
+        if "\n" in ln:     # A batch of lines (!table-data) or a multi-line header entry;
+            yield from minify_html(ln.split("\n"))
+            continue
+        if raw:
+            yield ln
+            raw = not RAW_CLOSE.search(ln)
+            continue
+        opened = RAW_OPEN.search(ln)
+        if opened and not RAW_CLOSE.search(ln, opened.end()):
+            raw = True
+            yield ln.rstrip() if opened.start() == 0 else ln.strip()
+            continue
+        ln = ln.strip()
+        if ln:
+            yield ln
+
+
+class OutputWriter():
+    """Writes html lines to fn by way of a temporary file, renamed into place only if the content changed
+
+    With gzip_level a precompressed fn.gz (deterministic: no name or mtime in it) is written alongside, and with
+    etag a fn.etag sidecar holding the sha256 of fn's content.  Use as a context manager, then write_html().
+    """
+    FLUSH_BYTES = 1 << 16
+
+    def __init__(self, fn: str, gzip_level: int = None, etag: bool = False) -> NoReturn:
+        self._fn = fn
+        self._gzip_level = gzip_level
+        self._etag = etag
+        self.changed = None     # After the with block: whether fn (or fn.gz/fn.etag) had to be replaced;
+        self.digest = None
+
+    @staticmethod
+    def _temp(fn: str) -> str:
+        parent, name = os.path.split(fn)
+        return os.path.join(parent, f".{name}.{os.getpid()}.tmp")
+
+    def __enter__(self):
+        import hashlib
+        self._hash = hashlib.sha256()
+        self._size = 0
+        self._buf = [ ]
+        self._buffered = 0
+        self._tmp = OutputWriter._temp(self._fn)
+        self._ofd = open(self._tmp, 'wb')
+        self._gz = None
+        if self._gzip_level is not None:
+            import zlib
+            self._gz = zlib.compressobj(self._gzip_level, zlib.DEFLATED, 31)   # 31: gzip framing;
+            self._gz_tmp = OutputWriter._temp(f"{self._fn}.gz")
+            self._gz_ofd = open(self._gz_tmp, 'wb')
+        return self
+
+    def write(self, s: str) -> NoReturn:
+        self._buf.append(s)
+        self._buffered += len(s)
+        if self._buffered >= OutputWriter.FLUSH_BYTES:
+            self._flush()
+
+    def write_html(self, html) -> NoReturn:
+        """Write lines joined by "\n" (the same bytes as HROFFFile.write), a few thousand lines per write"""
+        import itertools
+        html = iter(html)
+        first = True
+        while True:
+            batch = list(itertools.islice(html, 4096))
+            if not batch:
+                break
+            self.write("\n".join(batch) if first else "\n" + "\n".join(batch))
+            first = False
+
+    def _flush(self) -> NoReturn:
+        data = "".join(self._buf).encode('utf-8')
+        self._buf.clear()
+        self._buffered = 0
+        self._hash.update(data)
+        self._size += len(data)
+        self._ofd.write(data)
+        if self._gz is not None:
+            self._gz_ofd.write(self._gz.compress(data))
+
+    def __exit__(self, kind, value, tb) -> bool:
+        try:
+            if kind is None:
+                self._flush()
+                if self._gz is not None:
+                    self._gz_ofd.write(self._gz.flush())
+        finally:
+            self._ofd.close()
+            if self._gz is not None:
+                self._gz_ofd.close()
+        if kind is not None:
+            for tmp in ( self._tmp, self._gz_tmp if self._gz is not None else None ):
+                if tmp and os.path.exists(tmp):
+                    os.remove(tmp)
+            return False
+        self.digest = self._hash.hexdigest()
+        same = self._unchanged()
+        self.changed = not same
+        OutputWriter._settle(self._tmp, self._fn, same)
+        if self._gz is not None:
+            self.changed |= OutputWriter._settle(self._gz_tmp, f"{self._fn}.gz", same)
+        if self._etag:
+            self.changed |= self._write_sidecar(f"{self._fn}.etag", f"{self.digest}\n")
+        return False
+
+    def _unchanged(self) -> bool:
+        # Only a file of the same size is worth reading back and hashing;
+        try:
+            if os.path.getsize(self._fn) != self._size:
+                return False
+        except OSError:
+            return False
+        import hashlib
+        h = hashlib.sha256()
+        with open(self._fn, 'rb') as ifd:
+            for block in iter(lambda: ifd.read(1 << 20), b''):
+                h.update(block)
+        return h.hexdigest() == self.digest
+
+    @staticmethod
+    def _settle(tmp: str, fn: str, same: bool) -> bool:
+        # Rename tmp over fn, unless fn already holds the same content; True if fn was replaced;
+        if same and os.path.exists(fn):
+            os.remove(tmp)
+            return False
+        os.replace(tmp, fn)
+        return True
+
+    @staticmethod
+    def _write_sidecar(fn: str, text: str) -> bool:
+        try:
+            with open(fn, 'r') as ifd:
+                if ifd.read() == text:
+                    return False
+        except OSError:
+            pass
+        tmp = OutputWriter._temp(fn)
+        with open(tmp, 'w') as ofd:
+            ofd.write(text)
+        os.replace(tmp, fn)
+        return True
+
+
+class Macro():
+    """A !define'd block, compiled once: lines without {{param}} are lexed up front, the rest are split into
+    literal text and parameter slots so an expansion is only string joins and a lex of the changed lines
+
+    A macro is pure when its body can't touch anything but the body (no directives, no .title/.css/.js, no
+    computed element names or line types); only pure macros have their expansions memoized.
+    """
+    PARAM = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+    SIDE_EFFECTS = ( 'title', 'css', 'js' )
+    SEPARATOR = re.compile(r'(?<!\S)(//|::)(?!\S)')    # As the lexer counts them: whole words;
+    REFERENCES = { '//': '&#47;&#47;', '::': '&#58;&#58;' }
+
+    def __init__(self, name: str, params: List, lines: List) -> NoReturn:
+        self.name = name
+        self.params = tuple(params)
+        self.pure = True
+        self._lines = [ ]   # Components, or [ literal, param index, literal, ... ];
+        self._separated = set()     # Indexes of the slotted lines whose own text has '::'/'//' words;
+        slots = { param: i for i, param in enumerate(self.params) }
+        for ln in lines:
+            tag = ln.split(None, 1)[0][1:] if ln.startswith('.') and ln.strip() != '.' else ""
+            if ln.startswith('!') or tag in Macro.SIDE_EFFECTS or '{{' in tag:
+                self.pure = False
+            parts = Macro.PARAM.split(ln)
+            for i in range(1, len(parts), 2):
+                # Unknown names stay as written;
+                parts[i] = slots.get(parts[i], "{{%s}}" % parts[i])
+            if len(parts) > 1 and parts[0] == "" and type(parts[1]) == int:
+                # A value decides what kind of line this is, so it could be a directive or a .title;
+                self.pure = False
+            if len(parts) == 1 or all(type(part) == str for part in parts):
+                self._lines.append(Components("".join(parts)))
+            else:
+                if Macro.SEPARATOR.search(" x ".join(part for part in parts if type(part) == str)):
+                    self._separated.add(len(self._lines))
+                self._lines.append(parts)
+
+    def arguments(self, argString: str) -> tuple:
+        """'a // b // c' as one value per parameter; the last parameter takes whatever is left over"""
+        if not self.params:
+            return ( )
+        values = Components.SLASHED.split(argString.strip(), maxsplit=len(self.params) - 1) if argString.strip() else [ ]
+        return tuple(values) + ( "", ) * (len(self.params) - len(values))
+
+    def expand(self, args: tuple, literal: bool = False) -> Iterator[Components]:
+        """The body's tokens for args; with literal, args are data rather than hroff (see _literal)"""
+        for i, ln in enumerate(self._lines):
+            if type(ln) == list:
+                if literal:
+                    ln = Components(Macro._literal(ln, args, i in self._separated))
+                else:
+                    ln = Components("".join(args[part] if type(part) == int else part for part in ln))
+            yield ln
+
+    @staticmethod
+    def _literal(parts: List, args: tuple, separated: bool) -> str:
+        # A line whose values can't add structure: their '::'/'//' words (every '::'/'//', on a line that has
+        # its own, where the lexer would split glued ones too) and a line-type character they'd start the line
+        # with become character references, which render as the same text;
+        pieces = [ ]
+        for part in parts:
+            if type(part) == int:
+                part = args[part]
+                if separated:
+                    part = part.replace('//', Macro.REFERENCES['//']).replace('::', Macro.REFERENCES['::'])
+                else:
+                    part = Macro.SEPARATOR.sub(lambda mtch: Macro.REFERENCES[mtch.group(1)], part)
+                if part[:1] in Components.LINE_TYPES and not any(pieces):
+                    part = f"&#{ord(part[0])};{part[1:]}"
+            pieces.append(part)
+        return "".join(pieces)
+
+
+def _read_lines(fn: str) -> Iterator[str]:
+    with open(fn, 'r', newline='') as ifd:
+        yield from ifd
+
+
 class HROFFFile():
+    HEAD_WINDOW = 64    # stream(): input lines buffered before <head> is committed;
     SIMPLE = [ 'table', 'br', 'p', 'div' ]
     SIMPLE_WRAP = [ 'caption', 'h1', 'h2', 'h3', 'h4', 'h5' ]
+    ASSET_FLAGS = ( 'inline', 'min' )
+    TABLE_FLAGS = ( 'header', 'escape' )
+    TARGETS = ( 'full', 'body', 'head', 'min' )
+    CHUNK_MIN_BYTES = 1 << 20   # Smaller sources aren't worth starting a pool for;
+    EXIT_LINE = re.compile(rb'^!exit(?:[ \t\f\v\r]|$)', re.M)
+    DEFINE_LINE = re.compile(rb'^!define(?:[ \t\f\v\r]|$)', re.M)
+    REFERENCE_LINE = re.compile(rb'^!(?:include|fragment)[ \t\f\v][^\n]*', re.M)
+    MAX_MACRO_DEPTH = 32
+    ASSET_TAGS = dict(css=( '<link href="{}" rel="stylesheet">', '<style>', '</style>' ),
+                      js=( '<script src="{}"></script>', '<script>', '</script>' ))
+    STDIO = '-'
     def __init__(self, fn: str, **kwa: dict) -> NoReturn:
+        """fn is a path, or '-' for stdin; stream=True defers reading the input until stream()/save()
+
+        With lines= (any iterable of str) the input comes from memory and fn is just a name; base_dir=
+        is then where !include/!fragment files are looked for, unless resolver= is given:
+        resolver(name, directive) returns the named file's lines (or text), or None if there's no such file.
+
+        fingerprint=True links css/js under content-hashed names (written beside the output by save());
+        minify_assets=True minifies every inlined or fingerprinted asset, as the per-asset 'min' flag does.
+        chunk_jobs=N renders a source bigger than CHUNK_MIN_BYTES in line chunks across N processes.
+        reference=True lexes with the reference parser (Components._parse_reference), for differential checks.
+        save() options: minify=True trims whitespace from the html, gzip_level=1..9 also writes <output>.gz,
+        etag=True writes an <output>.etag sidecar with the content hash (see OutputWriter).
+        prefetch=N reads every !include/!fragment file (transitively) on N threads before rendering, for sources on
+        slow (network) filesystems; files not in by prefetch_timeout seconds (30) are read in line as usual.
+        tokens= (an iterable of Components, ie: from parse_document or Template) is rendered as is, as if it came
+        from lines=.
+        targets=[ ( kind, path ), ... ] has save() write each target kind (see target()) to its path, in place of
+        the default output.
+        """
         self._fn = fn
-        if not os.path.isfile(fn):
+        self._lines = kwa.get('lines', None)
+        self._resolver = kwa.get('resolver', None)
+        self._tokens = kwa.get('tokens', None)
+        if self._tokens is not None and self._lines is None:
+            self._lines = ( )   # Behaves as in-memory input: base_dir=, and !exit just ends the document;
+        if self._lines is None and fn != HROFFFile.STDIO and not os.path.isfile(fn):
             raise RuntimeError(f"No such file {fn}")
         self._parent_dir, self._fn_only = os.path.split(fn)
-        HROFFFile.GEN_HANDLERS = dict(title=self._gen_title, css=self._gen_css, 
-                                      image=self._gen_image, img=self._gen_img, link=self._gen_link,
-                                      tr=self._gen_row, td=self._gen_row_data, tdnull=self._gen_td_null, 
-                                      th=self._gen_row_header)
+        if self._lines is not None:
+            self._parent_dir = kwa.get('base_dir', "")
         self._header = OrderedDict(title=None, css=[], js=[]) # DO NOT REORDER!
         self._wrapper = [ "<!doctype html>", "</html>" ]
         self._body = [ ]
         self._head = [ ]
+        self._ofn = None
+        self._deps = [ ]    # Every file pulled in by !include/!fragment (or inlined/fingerprinted), in order;
+        self._assets = [ ]  # ( fingerprinted href, lines ) for save() to write;
+        self._fingerprint = kwa.get('fingerprint', False)
+        self._minify_assets = kwa.get('minify_assets', False)
+        self._chunk_jobs = kwa.get('chunk_jobs', None)
+        self._minify = kwa.get('minify', False)
+        self._gzip_level = kwa.get('gzip_level', None)
+        self._etag = kwa.get('etag', False)
+        self._targets = kwa.get('targets', None) or [ ]
+        for kind, _ in self._targets:
+            if kind not in HROFFFile.TARGETS:
+                raise RuntimeError(f"Unknown target {kind}: one of {', '.join(HROFFFile.TARGETS)}")
+        self._changed = None    # save(): whether the output file had to be rewritten;
+        self._streaming = kwa.get('stream', False) or fn == HROFFFile.STDIO
+        self._head_flushed = False
+        self._exited = False
+        self._pending = None    # stream(): html batches a directive left to be pulled after its line;
+        self._macros = { }
+        self._include_memo = { }    # Include.expand, once per file per build;
+        self._located = { }         # !include/!fragment name -> path (None: no such file), so each is looked up once;
+        self._lookups = FileLookups()   # Every file's stat and real path, taken once (by the prefetch, if any);
+        self._prefetch = kwa.get('prefetch', None)
+        self._prefetch_timeout = kwa.get('prefetch_timeout', None) or 30.0
+        self._macro_memo = { }  # ( name, args ) -> body lines of a pure macro's expansion;
+        self._macro_depth = 0
+        self._defining = None   # ( name, params, lines ) between !define and !enddefine;
         # Cheap (temporary?) hack
         self._end_segment = self._end_simple
-        rc = self._load(fn)
-        self._ibuf = self._load(fn)
-        self._input_len = len(self._ibuf)
+        self._stats = kwa.get('stats', None)
+        if self._stats is not None:
+            self._process = self._process_timed
+            self._dispatch = self._dispatch_timed
+        self._reference = kwa.get('reference', False)
+        if self._reference:
+            self._process = self._process_reference
+        t0 = time.perf_counter()
+        self._ast_cache = kwa.get('ast_cache', False) and not self._streaming
+        self._ast_stamp = None
+        if self._lines is not None:
+            self._ast_cache = False
+        if self._ast_cache:
+            self._ast_stamp = os.stat(fn)   # Before reading, so a racing edit just looks stale next time;
+            self._tokens = load_ast(fn)
+        if self._streaming or self._tokens is not None:
+            self._ibuf = None
+        else:
+            self._ibuf = self._load(fn)
+        self._input_len = 0     # Counted as run() consumes the input;
+        if self._stats is not None:
+            self._stats.phase('load', time.perf_counter() - t0)
         self._indent = 0
         return
 
     def __len__(self):
-        return len(self._html)
+        return len(self._assemble())
+
+    def _add_dependency(self, fn: str) -> NoReturn:
+        if fn not in self._deps:
+            self._deps.append(fn)
 
     def _add_comment(self, comment: str) -> NoReturn:
         self.append(f"<!-- {comment} -->")
@@ -403,8 +1438,14 @@ class HROFFFile():
     def append_indented(s: str) -> NoReturn:
         self._body.append(f"{' ' * self._indent}{s}")
 
+    @property
+    def dependencies(self) -> List:
+        return list(self._deps)
+
     def _assemble(self) -> List:
-        html = [ self._wrapper[0] ]
+        return list(self._iter_html())
+
+    def _head_lines(self) -> List:
         hdr = self._header
         output_hdr = [ ]
         keys = list(hdr.keys())
@@ -414,11 +1455,35 @@ class HROFFFile():
                 if hdr[k]:
                     output_hdr.append(self._expand_header(k, hdr))
             output_hdr.append("</head>")
-            html += output_hdr
-        body = [ "<body>" ] + self._body + [ "</body>" ]
-        html +=  body 
-        html.append(self._wrapper[-1])
-        return html
+        return output_hdr
+
+    def target(self, kind: str) -> Iterator[str]:
+        """The rendered page as kind (TARGETS), after run(); every kind reads the one rendered body
+
+        full: the whole document; body: the body's content, to embed elsewhere; head: the <head> element;
+        min: the whole document, minified."""
+        if kind == 'full':
+            return self._iter_html()
+        if kind == 'body':
+            return iter(self._body)
+        if kind == 'head':
+            return iter(self._head_lines())
+        if kind == 'min':
+            return minify_html(self._iter_html())
+        raise RuntimeError(f"Unknown target {kind}: one of {', '.join(HROFFFile.TARGETS)}")
+
+    def target_path(self, path: str) -> str:
+        # {stem} is the source's path without its extension, so one pattern serves a whole batch;
+        return path.replace('{stem}', os.path.splitext(self._fn)[0])
+
+    def _iter_html(self) -> Iterator[str]:
+        # The whole document from the rendered body, without copying the body;
+        yield self._wrapper[0]
+        yield from self._head_lines()
+        yield "<body>"
+        yield from self._body
+        yield "</body>"
+        yield self._wrapper[-1]
 
     def _end_simple(self, components: dict) -> NoReturn:
         self.append(components.start)
@@ -426,21 +1491,164 @@ class HROFFFile():
     def _expand_header(self, k: AnyStr, hdr_dict: Dict) -> AnyStr:
         if k == 'title':
             return f"    <{k}>{hdr_dict[k]}</title>"
-        if k == 'css':
-            # Need to add support for INLINE operator
-            # <link href="css/bootstrap.css" rel="stylesheet">
-            output_css = ""
-            for css in hdr_dict[k]:
-                output_css += f'    <link href="{css}" rel="stylesheet">\n'
-                return output_css[:-1]  # Lose last newline;
+        if k in HROFFFile.ASSET_TAGS:
+            # Entries are finished <link>/<script>/<style> markup, built by _add_asset;
+            return "\n".join(hdr_dict[k])
         return f"<!-- unknown header {k} value {hdr_dict[k]} -->"
 
     def extend_last(self, s: str) -> NoReturn:
         self._body[-1] += s
 
     def _gen_css(self, components: Components) -> NoReturn:
-        css_entry = components.argString
-        self._header['css'].append(css_entry)
+        self._add_asset('css', components.args, components.line)
+
+    def _gen_js(self, components: Components) -> NoReturn:
+        self._add_asset('js', components.args, components.line)
+
+    def _add_asset(self, kind: str, args: List, ln: str) -> NoReturn:
+        # .css/.js/!css/!js <file> [inline] [min]: a link, the file's content inline, or a fingerprinted link;
+        if self._late_header(kind, ln):
+            return
+        href = " ".join(arg for arg in args if arg and arg not in HROFFFile.ASSET_FLAGS)
+        if not href:
+            return self.warning(f"No file in {kind}: {ln}")
+        inline = 'inline' in args
+        link, open_tag, close_tag = HROFFFile.ASSET_TAGS[kind]
+        if inline or self._fingerprint:
+            lines = self._asset_lines(href, kind, self._minify_assets or 'min' in args)
+            if lines is None:
+                if inline:  # Still link it, so the page works wherever the file does turn up;
+                    self.warning(f"No such {kind} file {href}: {ln}")
+            elif inline:
+                self._header[kind].append("\n".join([ f"    {open_tag}", *lines, f"    {close_tag}" ]))
+                return
+            else:
+                href = fingerprinted(href, lines)
+                self._assets.append(( href, lines ))
+        self._header[kind].append(f"    {link.format(href)}")
+
+    def _asset_lines(self, href: str, kind: str, minify: bool) -> List:
+        # Only relative paths are files of ours; urls and site-absolute paths are left alone;
+        if '://' in href or href.startswith('/'):
+            return None
+        if self._resolver is not None:
+            lines = self._resolver(href, kind)
+            if lines is None:
+                return None
+            lines = lines.splitlines() if isinstance(lines, str) else [ ln.rstrip() for ln in lines ]
+            self._add_dependency(href)
+            return minify_asset(lines, kind) if minify else lines
+        ok, fn = self._qualify_file(href, [ kind, href ], kind)
+        if not ok:
+            return None
+        self._add_dependency(fn)
+        if not minify:
+            return SOURCE_CACHE.lines(fn, self._lookups.stat(fn))
+        return SOURCE_CACHE.rendered(fn, lambda lines: minify_asset(lines, kind), key=f"min-{kind}",
+                                     known=self._lookups.stat(fn))
+
+    def _begin_define(self, fields: List, ln: str) -> NoReturn:
+        # !define NAME param ...; the lines up to !enddefine are collected instead of rendered;
+        words = [ word for word in fields[1:] if word ]
+        if not words:
+            return self.warning(f"No name in !define: {ln}")
+        self._defining = ( words[0], words[1:], [ ], self._dispatch )
+        self._dispatch = self._collect_define
+
+    def _collect_define(self, components: Components) -> NoReturn:
+        if components.type == 'directive' and components.line.split(None, 1)[0] == '!enddefine':
+            name, params, lines, dispatch = self._defining
+            self._defining = None
+            self._dispatch = dispatch
+            self._macros[name] = Macro(name, params, lines)
+            # Expansions of whatever this name meant before are stale;
+            self._macro_memo = { key: body for key, body in self._macro_memo.items() if key[0] != name }
+            return
+        self._defining[2].append(components.line)
+
+    def _unterminated_define(self) -> NoReturn:
+        if self._defining is not None:
+            self._dispatch = self._defining[3]
+            self.warning(f"No !enddefine for !define {self._defining[0]}")
+            self._defining = None
+
+    def _expand_macro(self, ln: str) -> NoReturn:
+        # !macro NAME a // b // c;
+        words = ln.split(None, 2)
+        if len(words) < 2:
+            return self.warning(f"No name in !macro: {ln}")
+        macro = self._macros.get(words[1], None)
+        if macro is None:
+            return self.warning(f"Unknown macro {words[1]}: {ln}")
+        if self._macro_depth >= HROFFFile.MAX_MACRO_DEPTH:
+            return self.warning(f"Macros nested more than {HROFFFile.MAX_MACRO_DEPTH} deep: {ln}")
+        args = macro.arguments(words[2] if len(words) > 2 else "")
+        key = ( macro.name, args )
+        if macro.pure and key in self._macro_memo:
+            self._body += self._macro_memo[key]
+            return
+        mark = len(self._body)
+        self._macro_depth += 1
+        try:
+            for components in macro.expand(args):
+                self._dispatch(components)
+                if self._exited:
+                    break
+        finally:
+            self._macro_depth -= 1
+        if macro.pure:
+            self._macro_memo[key] = self._body[mark:]
+
+    def _table_data(self, fields: List, ln: str) -> NoReturn:
+        # !table-data <file> [header] [escape] [columns=a,b,2] [batch=N] [format=csv|tsv|jsonl]: <tr> rows;
+        words = [ word for word in fields[1:] if word ]
+        opts = dict(word.split('=', 1) for word in words if '=' in word)
+        names = [ word for word in words if '=' not in word and word not in HROFFFile.TABLE_FLAGS ]
+        if not names:
+            return self.warning(f"No file in !table-data: {ln}")
+        fn = names[0]
+        fmt = opts.get('format', TABLE_FORMATS.get(os.path.splitext(fn)[1].lower(), 'csv'))
+        if self._resolver is not None:
+            lines = self._resolver(fn, 'table-data')
+            if lines is None:
+                return self.warning(f"No such table-data file {fn}: {ln}")
+            lines = lines.splitlines() if isinstance(lines, str) else lines
+            self._add_dependency(fn)
+        else:
+            ok, err_or_fn = self._qualify_file(fn, fields, 'table-data')
+            if not ok:
+                return self._missing_file(fn, fields, f"{err_or_fn}: {ln}")
+            self._add_dependency(err_or_fn)
+            lines = _read_lines(err_or_fn)
+        header = 'header' in words
+        columns = [ column for column in opts.get('columns', "").split(',') if column ]
+        try:
+            rows = table_data_rows(lines, fmt, header=header, columns=columns)
+            batch = int(opts.get('batch', 1000))
+        except ValueError as e:
+            return self.warning(f"{e}: {ln}")
+        html = table_data_html(rows, header=header, escape='escape' in words, batch=max(batch, 1))
+        if self._streaming:
+            self._pending = html    # stream() writes it out batch by batch;
+            return
+        self._body.extend(html)
+
+    @property
+    def assets(self) -> List:
+        """( href, lines ) of each fingerprinted asset the page links to"""
+        return list(self._assets)
+
+    def save_assets(self, out_dir: str) -> NoReturn:
+        """Write fingerprinted assets under out_dir; a name that already exists already has this content"""
+        for href, lines in self._assets:
+            fn = os.path.join(out_dir, href)
+            if os.path.exists(fn):
+                continue
+            os.makedirs(os.path.dirname(fn) or ".", exist_ok=True)
+            tmp = f"{fn}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as ofd:
+                ofd.write("\n".join(lines) + "\n")
+            os.replace(tmp, fn)
 
     def _gen_image(self, components: Components) -> NoReturn:
         # Generate an image link from: .link <url>, as opposed to <img param=v param=v...> which would be .img
@@ -449,6 +1657,7 @@ class HROFFFile():
         self.append(f'<img {preopts} src="{url}"/>')
 
     def _gen_img(self, components: Components) -> NoReturn:
+        components = components.copy()  # Re-parsing changes the token, and macros/templates reuse theirs;
         components.parse_subterms()
         html = f'<img {" ".join(components.options)}/>'
         self.append(html)
@@ -539,6 +1748,7 @@ class HROFFFile():
         return
 
     def _gen_simple_wrap(self, components: Components) -> NoReturn:
+        components = components.copy()  # As in _gen_img;
         components.parse_subterms()
         ostr = f"{components.withopts}{components.argString}{components.end}"
         self.append(ostr)
@@ -554,6 +1764,7 @@ class HROFFFile():
             olist += children
             olist.append(f"</{inner_tag}></td>")
             ostr = "".join(olist)
+            from pprint import pprint
             pprint(components) ; print(ostr) ; sys.exit(1)
             return self.append(ostr)
 
@@ -571,48 +1782,194 @@ class HROFFFile():
         self.append("<td>&nbsp;</td>")
 
     def _gen_title(self, components: Components) -> NoReturn:
+        if self._late_header('title', components.line):
+            return
         self._header['title'] = components.argString
 
-    def _load(self, fn: str) -> str:
-        if not os.path.isfile(fn):
+    def _late_header(self, k: str, ln: str) -> bool:
+        # stream() has already written <head>, so there is nowhere left to put this;
+        if not self._head_flushed:
+            return False
+        self.warning(f"{k} after <head> was streamed out, ignored: {ln}")
+        return True
+
+    def _iter_input(self, fn: str) -> Iterator[str]:
+        if self._lines is not None:
+            yield from self._iter_lines(self._lines)
+            return
+        if fn == HROFFFile.STDIO:
+            yield from self._iter_lines(sys.stdin)
+            return
+        yield from MappedLines(fn, skip_comments=True)
+
+    @staticmethod
+    def _iter_lines(ifd) -> Iterator[str]:
+        # As MappedLines reads files: a CRLF source renders the same from stdin, lines= or a file;
+        for ln in ifd:
+            if ln.endswith('\n'):
+                ln = ln[:-1] # strip EOL BUT NOTHING ELSE!
+            if ln.endswith('\r'):
+                ln = ln[:-1]
+            if not ln.startswith(';'):
+                yield ln
+
+    def _load(self, fn: str):
+        if self._lines is None and fn != HROFFFile.STDIO and not os.path.isfile(fn):
             print(f"No such file {fn}")
             return False
-        with open(fn, 'r') as ifd:
-            ibuf = [ln[:-1] for ln in ifd] # strip EOL BUT NOTHING ELSE!
-            ibuf = [ln for ln in ibuf if not ln.startswith(';')]
-        return ibuf
+        if self._lines is None and fn != HROFFFile.STDIO:
+            return MappedLines(fn, skip_comments=True)
+        return list(self._iter_input(fn))
+
+    def _resolved_directive(self, directive: str, fields: List, ln: str) -> NoReturn:
+        if not len(fields) > 1:
+            return self.warning(f"No file in !{directive}: {ln}")
+        fn = fields[-1]
+        lines = self._resolver(fn, directive)
+        if lines is None:
+            return self.warning(f"No such {directive} file {fn}: {ln}")
+        if isinstance(lines, str):
+            lines = lines.splitlines()
+        self._add_dependency(fn)
+        lines = [ each.rstrip() for each in lines ]
+        if directive == 'fragment':
+            self.append(lines)
+            return
+        html, deps = Include.expand(fn, self._include_memo, resolver=self._resolver, lines=lines)[:2]
+        for dep in deps:
+            self._add_dependency(dep)
+        self.append(html)
 
     def _qualify_file(self, fn: str, fields: List, directive: str):
         if not len(fields) > 1:
             return False, f"No file in !{directive}"
-        if not os.path.isfile(fn):
-            fp = os.path.join(self._parent_dir, fn)
-            if os.path.isfile(fp):
-                return True, fp
+        if fn not in self._located:
+            self._located[fn] = self._locate(fn)
+        fp = self._located[fn]
+        if fp is None:
             return False, f"No such {directive} file {fn}"
-        return True, fn
+        return True, fp
+
+    def _locate(self, fn: str) -> str:
+        # As given (relative to the working directory), then beside the page;
+        if self._lookups.isfile(fn):
+            return fn
+        fp = os.path.join(self._parent_dir, fn)
+        return fp if self._lookups.isfile(fp) else None
+
+    def _missing_file(self, fn: str, fields: List, warning: str) -> NoReturn:
+        # Everywhere _locate looked is a dependency, so the page goes stale when the file turns up;
+        if len(fields) > 1 and fn:
+            self._add_dependency(fn)
+            self._add_dependency(os.path.join(self._parent_dir, fn))
+        self.warning(warning)
+
+    @staticmethod
+    def _references(lines) -> Iterator[tuple]:
+        # ( directive, name ) for each !include/!fragment line, named as process_directives would see them;
+        for ln in lines:
+            if ln.startswith('!include') or ln.startswith('!fragment'):
+                fields = Components.WORDS.split(ln)
+                if fields[0][1:] in ( 'include', 'fragment' ) and len(fields) > 1 and fields[-1]:
+                    yield fields[0][1:], fields[-1]
+
+    def _referenced(self) -> List[tuple]:
+        # The page's own references: a file source is scanned as bytes, without decoding every line;
+        if self._lines is None and self._fn != HROFFFile.STDIO:
+            import mmap
+            with open(self._fn, 'rb') as ifd:
+                if os.fstat(ifd.fileno()).st_size == 0:
+                    return [ ]
+                with mmap.mmap(ifd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    found = [ mtch.group(0).decode('utf-8', 'replace').rstrip('\r')
+                              for mtch in HROFFFile.REFERENCE_LINE.finditer(mm) ]
+            return list(HROFFFile._references(found))
+        if isinstance(self._lines, ( list, tuple )):
+            return list(HROFFFile._references(self._lines))
+        return [ ]      # An iterator can only be read once, by the render;
+
+    def prefetch_includes(self) -> NoReturn:
+        """Find, stat and read every file the page includes (and those include...) on the prefetch threads
+
+        Reads go to SOURCE_CACHE, where the render finds them; lookups to the page's located names.  Anything
+        that fails or is still outstanding at the timeout is left to the render, which reads it as it always did."""
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+        deadline = time.monotonic() + self._prefetch_timeout
+        pool = ThreadPoolExecutor(max_workers=self._prefetch or 4, thread_name_prefix='hroff-prefetch')
+        pending, seen = set(), set()
+
+        def submit(references, parent: str, top: bool) -> NoReturn:
+            for directive, name in references:
+                if ( parent, name, top ) not in seen:
+                    seen.add(( parent, name, top ))
+                    pending.add(pool.submit(self._prefetch_one, directive, name, parent, top))
+        try:
+            submit(self._referenced(), self._parent_dir, True)
+            while pending:
+                done, _ = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    pending.discard(future)
+                    path, references = future.result()
+                    if references:
+                        submit(references, os.path.dirname(path), False)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _prefetch_one(self, directive: str, name: str, parent: str, top: bool) -> tuple:
+        # On a prefetch thread: ( path, the references in it ); never raises;
+        try:
+            if top:
+                path = self._located[name] = self._locate(name)
+            else:
+                path = self._lookups.locate(name, parent)
+            if path is None:
+                return None, ( )
+            lines = SOURCE_CACHE.warm(path, self._lookups.stat(path))
+            return path, ( ) if directive == 'fragment' else list(HROFFFile._references(lines))
+        except Exception:
+            return None, ( )
 
     def process_directives(self, ln: str) -> NoReturn:
         fields = Components.WORDS.split(ln)
         directive = fields[0][1:]
+        if self._resolver is not None and directive in ( 'fragment', 'include' ):
+            return self._resolved_directive(directive, fields, ln)
         if directive == 'fragment':     # Non-expanding include
             fn = fields[-1]
             ok, err_or_fn = self._qualify_file(fn, fields, directive)
             if not ok:
-                return self.warning(f"{err_or_fn}: {ln}")
-            frag = Fragment(err_or_fn)
+                return self._missing_file(fn, fields, f"{err_or_fn}: {ln}")
+            self._add_dependency(err_or_fn)
+            frag = Fragment(err_or_fn, self._lookups.stat(err_or_fn))
             self.append(frag.list)
             return
         elif directive == 'include':
             fn = fields[-1]
             ok, err_or_fn = self._qualify_file(fn, fields, directive)
             if not ok:
-                return self.warning(f"{err_or_fn}: {ln}")
-            include = Include(err_or_fn)
-            include_buf = include.render
-            self.append(include_buf)
+                return self._missing_file(fn, fields, f"{err_or_fn}: {ln}")
+            self._add_dependency(err_or_fn)
+            html, deps = Include.expand(err_or_fn, self._include_memo, lookups=self._lookups)[:2]
+            for dep in deps:
+                self._add_dependency(dep)
+            self.append(html)
             return
+        elif directive == 'define':
+            return self._begin_define(fields, ln)
+        elif directive == 'enddefine':
+            return self.warning(f"!enddefine without !define: {ln}")
+        elif directive == 'macro':
+            return self._expand_macro(ln)
+        elif directive == 'table-data':
+            return self._table_data(fields, ln)
+        elif directive in HROFFFile.ASSET_TAGS:
+            return self._add_asset(directive, fields[1:], ln)
         elif directive == 'exit':
+            if self._streaming or self._lines is not None:  # Just stop; the caller closes the document;
+                self._exited = True
+                return
             if not fields:
                 self.save()
             else:
@@ -627,72 +1984,944 @@ class HROFFFile():
     def run(self) -> NoReturn:
         test_string = "" # ".rowslabelcheckbox Front 3/4 Driver Wheel Turn // Front 3/4 Passenger Wheel Turn // Front 3/4 Driver Wheel Turn DRLs On // Front 3/4 Passenger Wheel Turn DRLs On // Profile Passenger // Studio 360 // City Bridge Environment 360 // City Bridge Interior Pano // Showroom Environment Interior Pano" # '.select name="select_name" id="select_id" :: Option_1 // Option Two // Option_3'
         if test_string:
+            from pprint import pprint
             components = Components(test_string)
-            components['type'] = 'start'
             pprint(components)
             print(components.render)
             sys.exit(1)
-        for ln in self._ibuf:
-            components = Components(ln)
-            name, type_ = components.name, components.type
-            if components.renderable:
-                self.append(components.render)
-                continue
-            if type_ == 'directive':
-                self.process_directives(ln)
-                continue
-            if type_ == 'start':  # More complex segment renders;
-                self._start_segment(components)
-                continue
+        if self._streaming:
+            return          # Rendering happens as stream() is consumed;
+        if self._prefetch and self._resolver is None:
+            self.prefetch_includes()
+        if self._chunkable():
+            return self._run_chunked()
+        if self._ast_cache or self._tokens is not None:
+            if self._tokens is None:
+                t0 = time.perf_counter()
+                self._tokens = parse_document(self._ibuf)
+                if self._stats is not None:
+                    self._stats.phase('parse', time.perf_counter() - t0)
+                save_ast(self._fn, self._tokens, self._ast_stamp)
+            for count, components in enumerate(self._tokens, 1):
+                self._input_len = count
+                self._dispatch(components)
+                if self._exited:
+                    break
+            self._unterminated_define()
+            return
+        for count, ln in enumerate(self._ibuf, 1):
+            self._input_len = count
+            self._process(ln)
+            if self._exited:
+                break
+        self._unterminated_define()
+
+    def _chunkable(self) -> bool:
+        # Only plain file renders: stats, the AST cache, resolvers and the reference parser all want to see
+        # every line in-process;
+        if not self._chunk_jobs or self._chunk_jobs < 2 or not isinstance(self._ibuf, MappedLines):
+            return False
+        if self._ast_cache or self._stats is not None or self._resolver is not None or self._reference:
+            return False
+        if os.path.getsize(self._fn) < HROFFFile.CHUNK_MIN_BYTES:
+            return False
+        # Macro definitions carry state from line to line (and chunk to chunk);
+        with open(self._fn, 'rb') as ifd:
+            import mmap
+            with mmap.mmap(ifd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return HROFFFile.DEFINE_LINE.search(mm) is None
+
+    def _chunk_ranges(self) -> List:
+        # Byte ranges ending just after a newline, stopping short of the first !exit line; and that line;
+        import mmap
+        with open(self._fn, 'rb') as ifd:
+            mm = mmap.mmap(ifd.fileno(), 0, access=mmap.ACCESS_READ)
+        with mm:
+            end, exit_line = len(mm), None
+            found = HROFFFile.EXIT_LINE.search(mm)
+            if found:
+                nl = mm.find(b'\n', found.start())
+                exit_line = mm[found.start():len(mm) if nl < 0 else nl].decode('utf-8').rstrip('\r')
+                end = found.start()
+            count = self._chunk_jobs * 4    # More chunks than workers, so a slow chunk doesn't idle the rest;
+            bounds = [ 0 ]
+            for i in range(1, count):
+                nl = mm.find(b'\n', end * i // count, end)
+                if nl < 0:
+                    break
+                if nl + 1 > bounds[-1]:
+                    bounds.append(nl + 1)
+            if end > bounds[-1]:
+                bounds.append(end)
+        return list(zip(bounds[:-1], bounds[1:])), exit_line
+
+    def _run_chunked(self) -> NoReturn:
+        """Render byte ranges of the source in a process pool and join them in order
+
+        Every line renders on its own, so the only state that crosses chunks is the header (.title: the last
+        one wins; .css/.js: in order), dependencies and assets.  !exit is found up front; the chunks stop
+        before it and it's processed here, after the merge, exactly as the serial path would."""
+        from concurrent.futures import ProcessPoolExecutor
+        ranges, exit_line = self._chunk_ranges()
+        options = dict(fingerprint=self._fingerprint, minify_assets=self._minify_assets)
+        with ProcessPoolExecutor(max_workers=self._chunk_jobs) as pool:
+            futures = [ pool.submit(_render_chunk, self._fn, start, stop, options) for start, stop in ranges ]
+            for future in futures:
+                part = future.result()
+                if part['body'] is not None:
+                    self._body.append(part['body'])
+                if part['header']['title'] is not None:
+                    self._header['title'] = part['header']['title']
+                for k in HROFFFile.ASSET_TAGS:
+                    self._header[k] += part['header'][k]
+                for fn in part['deps']:
+                    self._add_dependency(fn)
+                self._assets += part['assets']
+                self._input_len += part['lines']
+        if exit_line is not None:
+            self._input_len += 1
+            self.process_directives(exit_line)
+
+    def _process(self, ln: str) -> NoReturn:
+        self._dispatch(Components(ln))
+
+    def _process_reference(self, ln: str) -> NoReturn:
+        self._dispatch(Components(ln, reference=True))
+
+    def _process_timed(self, ln: str) -> NoReturn:
+        t0 = time.perf_counter()
+        components = Components(ln)
+        self._stats.phase('parse', time.perf_counter() - t0)
+        self._dispatch(components)
+
+    def _dispatch_timed(self, components: Components) -> NoReturn:
+        if self._macro_depth:   # A macro's body lines are timed as the !macro line, not a second time here;
+            return HROFFFile._dispatch(self, components)
+        t0 = time.perf_counter()
+        HROFFFile._dispatch(self, components)
+        seconds = time.perf_counter() - t0
+        self._stats.add(components.type, components.name or "", seconds)
+        self._stats.phase('render', seconds)
+
+    def _dispatch(self, components: Components) -> NoReturn:
+        handler = HROFFFile.HANDLERS.get(( components.type, components.name ), None)
+        if handler is None:
+            handler = HROFFFile.HANDLERS.get(( components.type, None ), None)
+            if handler is None:
+                return      # Comments and continuations;
+        handler(self, components)
+
+    def _append_rendered(self, components: Components) -> NoReturn:
+        self.append(components.render)
+
+    def _dispatch_directive(self, components: Components) -> NoReturn:
+        self.process_directives(components.line)
+
+    def _unknown_start(self, components: Components) -> NoReturn:
+        self._add_comment(f"Unknown command {components.name}: {components.line}")
 
     def save(self, fn = None) -> NoReturn:
-        if not fn:
-            prefix, ext = os.path.splitext(self._fn)
-            fn = f"{prefix}.html"
-        html = self._html = self._assemble()
-        ostr = "\n".join(html)
-        ofd = open(fn, 'w')
-        ofd.write(ostr)
-        rc = ofd.close()
-
-    def _start_segment(self, components: Components) -> NoReturn:
-        name = components.get('name', None)
-        if name in Components.CAN_RENDER_START:
-            self.append(components.render)
+        """Write the document to fn ('-' is stdout); in stream mode this is what drives rendering
+
+        With targets=, every target is written from the one render, and fn only if it's given."""
+        outputs = [ ( 'full', fn ) ] if fn or not self._targets else [ ]
+        outputs += [ ( kind, self.target_path(path) ) for kind, path in self._targets ]
+        if self._streaming and ( len(outputs) > 1 or outputs[0][0] not in ( 'full', 'min' ) ):
+            raise RuntimeError(f"{self._fn}: a streamed render only writes one full or min output")
+        if not outputs[0][1]:
+            if self._fn == HROFFFile.STDIO:
+                outputs[0] = ( 'full', HROFFFile.STDIO )
+            else:
+                prefix, ext = os.path.splitext(self._fn)
+                outputs[0] = ( 'full', f"{prefix}.html" )
+        self._ofn = outputs[0][1]
+        t0 = time.perf_counter()
+        stats = self._stats
+        if stats is not None:
+            rendering = stats.seconds('parse') + stats.seconds('render')
+        self._changed = False
+        for kind, fn in outputs:
+            if self._streaming:
+                html = self.stream() if kind == 'full' else minify_html(self.stream())
+            else:
+                html = self.target(kind)
+            if self._minify and kind != 'min':
+                html = minify_html(html)
+            if fn == HROFFFile.STDIO:
+                HROFFFile.write(sys.stdout, html)
+                sys.stdout.flush()
+                continue
+            with OutputWriter(fn, gzip_level=self._gzip_level, etag=self._etag) as ofd:
+                ofd.write_html(html)
+            self._changed |= ofd.changed
+        for out_dir in dict.fromkeys(os.path.dirname(fn) for _, fn in outputs if fn != HROFFFile.STDIO):
+            self.save_assets(out_dir)
+        if stats is not None:
+            # Streamed renders happen inside the write, and are already counted under parse/render;
+            rendering = stats.seconds('parse') + stats.seconds('render') - rendering
+            stats.phase('save', time.perf_counter() - t0 - rendering)
+            stats.finish()
+
+    @property
+    def stats(self) -> RenderStats:
+        return self._stats
+
+    def stream(self) -> Iterator[str]:
+        """Render the input lazily, yielding html lines as soon as they are produced
+
+        <head> is committed once HEAD_WINDOW input lines have been seen (or the input ends, or a !table-data
+        starts), so header lines (.title, .css) must come before that point; later ones are dropped with a
+        warning comment.
+        """
+        self._streaming = True
+        if self._prefetch and self._resolver is None:
+            self.prefetch_includes()
+        yield self._wrapper[0]
+        for count, ln in enumerate(self._iter_input(self._fn), 1):
+            self._input_len = count
+            self._process(ln)
+            if not self._head_flushed:
+                if count < HROFFFile.HEAD_WINDOW and self._pending is None:
+                    continue
+                yield from self._flush_head()
+            if self._body:
+                yield from self._body
+                self._body.clear()
+            if self._pending is not None:
+                pending, self._pending = self._pending, None
+                yield from pending
+            if self._exited:
+                break
+        self._unterminated_define()
+        if not self._head_flushed:
+            yield from self._flush_head()
+        yield from self._body
+        self._body.clear()
+        yield "</body>"
+        yield self._wrapper[-1]
+
+    def _flush_head(self) -> Iterator[str]:
+        self._head_flushed = True
+        yield from self._head_lines()
+        yield "<body>"
+
+    @staticmethod
+    def write(ofd, html) -> NoReturn:
+        # Same bytes as "\n".join(html), without building the string;
+        first = True
+        for ln in html:
+            if first:
+                ofd.write(ln)
+                first = False
+            else:
+                ofd.write("\n")
+                ofd.write(ln)
+
+    def warning(self, s: str) -> NoReturn:
+        self.append(f"<!-- WARNING: {s} -->")
+        return
+
+    # Unbound, and set once here rather than per instance, so concurrent renders can't cross handlers;
+    GEN_HANDLERS = dict(title=_gen_title, css=_gen_css, js=_gen_js,
+                        image=_gen_image, img=_gen_img, link=_gen_link,
+                        tr=_gen_row, td=_gen_row_data, tdnull=_gen_td_null,
+                        th=_gen_row_header)
+
+
+# ( line type, tag name ) -> handler(doc, components), keyed like Components.RENDERERS.  Built in the order the old
+# if-chains tested (renderable lines, then SIMPLE, SIMPLE_WRAP and GEN_HANDLERS), so the first table naming a tag
+# keeps it;
+HROFFFile.HANDLERS = { key: HROFFFile._append_rendered for key in Components.RENDERABLE }
+HROFFFile.HANDLERS[( 'directive', None )] = HROFFFile._dispatch_directive
+for _name in HROFFFile.SIMPLE:
+    HROFFFile.HANDLERS.setdefault(( 'start', _name ), HROFFFile._gen_simple)
+for _name in HROFFFile.SIMPLE_WRAP:
+    HROFFFile.HANDLERS.setdefault(( 'start', _name ), HROFFFile._gen_simple_wrap)
+for _name, _handler in HROFFFile.GEN_HANDLERS.items():
+    HROFFFile.HANDLERS.setdefault(( 'start', _name ), _handler)
+HROFFFile.HANDLERS[( 'start', None )] = HROFFFile._unknown_start
+del _name, _handler
+
+
+def register_tag(name: str, render = None, handler = None, line_type: str = 'start') -> NoReturn:
+    """Add (or replace) the tag .name (or ..name, with line_type='end')
+
+    render(components) returns the line's html, a str or a list of lines; it's used wherever lines render,
+    !include files and macros included.  handler(doc, components) gets the HROFFFile as well (doc.append(),
+    doc.warning(), ...), for tags with document state; like the built-in ones, those only run in the page itself.
+    Register before rendering: rendered includes are cached.
+    """
+    if ( render is None ) == ( handler is None ):
+        raise RuntimeError(f"register_tag {name}: give one of render= or handler=")
+    key = ( line_type, name )
+    if render is not None:
+        Components.RENDERERS[key] = render
+        Components.RENDERABLE.add(key)
+        HROFFFile.HANDLERS[key] = HROFFFile._append_rendered
+    else:
+        Components.RENDERERS.pop(key, None)
+        Components.RENDERABLE.discard(key)
+        HROFFFile.HANDLERS[key] = handler
+
+
+AST_MAGIC = 'hroff-ast'
+AST_VERSION = 1     # Bump whenever Components.parse (or its state layout) changes;
+
+
+def _render_chunk(fn: str, start: int, stop: int, options: Dict) -> Dict:
+    # Worker side of HROFFFile._run_chunked: one byte range of fn, rendered as a document of its own;
+    lines = MappedLines(fn, skip_comments=True, start=start, stop=stop)
+    doc = HROFFFile(fn, lines=lines, base_dir=os.path.dirname(fn), **options)
+    doc.run()
+    body = "\n".join(doc._body) if doc._body else None
+    return dict(body=body, header=dict(doc._header), deps=doc.dependencies, assets=doc._assets, lines=doc._input_len)
+
+
+def parse_document(lines) -> List[Components]:
+    """Lex lines into the document AST: one Components token per line, in order
+
+    Each token is a node: type is 'start'/'end' (element open/close, with name, options in subterms['opts'],
+    '::'/'//' children in subterms['children'] and '//' fields), 'directive' (name, args), 'text',
+    'html comment', 'hroff comment' or 'continuation'.  Nesting is implicit in start/end pairs, exactly
+    as in the source, so rendering an AST gives byte-identical output to rendering the text.
+    """
+    return [ Components(ln) for ln in lines ]
+
+
+def ast_cache_path(fn: str) -> str:
+    parent, fn_only = os.path.split(fn)
+    return os.path.join(parent, f".{fn_only}.ast")
+
+
+def load_ast(fn: str) -> List[Components]:
+    """The cached AST for fn, or None if there isn't one matching fn's current mtime/size"""
+    import gc
+    import marshal
+    # The AST is acyclic; letting the cycle collector rescan it over and over while it's built costs 3-5x;
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        st = os.stat(fn)
+        with open(ast_cache_path(fn), 'rb') as ifd:
+            header, states = marshal.loads(ifd.read())
+        if header != ( AST_MAGIC, AST_VERSION, marshal.version, st.st_mtime_ns, st.st_size ):
+            return None
+        from_state = Components.from_state
+        return [ from_state(state) for state in states ]
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def save_ast(fn: str, tokens: List[Components], st = None) -> bool:
+    """Serialize tokens next to fn; st is fn's stat from before it was read.  Failure to write is not an error"""
+    import marshal
+    try:
+        st = st or os.stat(fn)
+        header = ( AST_MAGIC, AST_VERSION, marshal.version, st.st_mtime_ns, st.st_size )
+        cfn = ast_cache_path(fn)
+        tmp = f"{cfn}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as ofd:
+            ofd.write(marshal.dumps(( header, [ components.state for components in tokens ] )))
+        os.replace(tmp, cfn)
+    except OSError:
+        return False
+    return True
+
+
+class BuildManifest():
+    """Persisted record of each page's inputs and output, so a rebuild only re-renders stale pages"""
+    VERSION = 1
+
+    def __init__(self, fn: str = '.hroff-manifest.json') -> NoReturn:
+        self._fn = fn
+        self._files = { }   # abspath -> [ mtime_ns, size, sha1 ]
+        self._pages = { }   # abspath of source -> dict(output=abspath, inputs={ abspath: sha1 })
+        self._checked = { } # abspath -> sha1 (or None) for this run; shared deps are only stat'd once;
+        self._dirty = False
+        self._load()
+
+    def _load(self) -> NoReturn:
+        if not os.path.isfile(self._fn):
             return
-        if name in HROFFFile.SIMPLE:
-            self._gen_simple(components)
+        import json
+        try:
+            with open(self._fn, 'r') as ifd:
+                manifest = json.load(ifd)
+        except (OSError, ValueError):
+            return                  # Unreadable manifest just means a full rebuild;
+        if manifest.get('version', None) != BuildManifest.VERSION:
             return
-        if name in HROFFFile.SIMPLE_WRAP:
-            self._gen_simple_wrap(components)
+        self._files = manifest.get('files', { })
+        self._pages = manifest.get('pages', { })
+
+    def digest(self, fn: str) -> str:
+        """Content hash of fn, re-hashed only when its mtime/size changed since last recorded"""
+        fn = os.path.abspath(fn)
+        if fn in self._checked:
+            return self._checked[fn]
+        try:
+            st = os.stat(fn)
+        except OSError:
+            self._checked[fn] = None
+            return None
+        stamp = self._files.get(fn, None)
+        if stamp and stamp[0] == st.st_mtime_ns and stamp[1] == st.st_size:
+            sha1 = stamp[2]
+        else:
+            sha1 = _file_sha1(fn)
+            self._files[fn] = [ st.st_mtime_ns, st.st_size, sha1 ]
+            self._dirty = True
+        self._checked[fn] = sha1
+        return sha1
+
+    def stale(self, source: str) -> bool:
+        page = self._pages.get(os.path.abspath(source), None)
+        if not page:
+            return True
+        if self.digest(page['output']) != page['output_sha1']:
+            return True
+        for fn, sha1 in page['inputs'].items():
+            if self.digest(fn) != sha1:
+                return True
+        return False
+
+    def record(self, status: Dict) -> NoReturn:
+        source = os.path.abspath(status['source'])
+        self._dirty = True
+        if not status['ok'] or not status['output']:
+            self._pages.pop(source, None)
             return
-        if name not in HROFFFile.GEN_HANDLERS:
-            self._add_comment(f"Unknown command {components.name}: {components.line}")
+        inputs = { }
+        for fn in [ source ] + [ os.path.abspath(dep) for dep in status.get('deps', [ ]) ]:
+            self._checked.pop(fn, None)
+            inputs[fn] = self.digest(fn)
+        output = os.path.abspath(status['output'])
+        self._checked.pop(output, None)
+        self._pages[source] = dict(output=output, output_sha1=self.digest(output), inputs=inputs)
+
+    def save(self) -> NoReturn:
+        if not self._dirty:
             return
-        HROFFFile.GEN_HANDLERS[name](components)
-        return
+        import json
+        tmp = f"{self._fn}.tmp"
+        with open(tmp, 'w') as ofd:
+            json.dump(dict(version=BuildManifest.VERSION, files=self._files, pages=self._pages), ofd)
+        os.replace(tmp, self._fn)
+        self._dirty = False
+
+
+def _file_sha1(fn: str) -> str:
+    import hashlib
+    h = hashlib.sha1()
+    with open(fn, 'rb') as ifd:
+        for block in iter(lambda: ifd.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def render_lines(lines, resolver = None, **kwa: dict) -> Iterator[str]:
+    """Render hroff source lines from memory, returning an iterator over the html lines
+
+    resolver(name, directive) supplies !include/!fragment files (lines or text, None if missing); without
+    one they're read from disk relative to base_dir=.  stream=True also consumes lines lazily, with the
+    streaming caveat that .title/.css must come early.  Safe to call from many threads at once.
+    """
+    hroff = HROFFFile(kwa.pop('name', '<string>'), lines=lines, resolver=resolver, **kwa)
+    if hroff._streaming:
+        return hroff.stream()
+    hroff.run()
+    return hroff._iter_html()
+
+
+def render_string(text: str, resolver = None, **kwa: dict) -> str:
+    """Render hroff source text to an html string; see render_lines"""
+    return "\n".join(render_lines(text.splitlines(), resolver=resolver, **kwa))
+
+
+def discover_sources(paths: List[str]) -> List[str]:
+    """Expand files, directories and glob patterns into a sorted list of .hroff sources"""
+    import glob
+    sources = [ ]
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                sources += [ os.path.join(dirpath, fn) for fn in filenames if fn.endswith('.hroff') ]
+        elif glob.has_magic(path):
+            for fn in glob.glob(path, recursive=True):
+                if os.path.isdir(fn):
+                    sources += discover_sources([ fn ])
+                elif fn.endswith('.hroff'):
+                    sources.append(fn)
+        else:
+            sources.append(path)
+    seen = set()
+    unique = [ ]
+    for fn in sources:
+        key = os.path.normpath(fn)
+        if key not in seen:
+            seen.add(key)
+            unique.append(fn)
+    return sorted(unique)
+
+
+def render_file(ifn: str, ofn: str = None, stats: bool = False, profile: bool = False, **kwa: dict) -> Dict:
+    """Render one source to html; never raises, returns a status dict (used as the batch worker)
+
+    kwa are HROFFFile options (stream=, ast_cache=, ...); stats/profile add RenderStats.as_dict() as 'stats'."""
+    t0 = time.perf_counter()
+    status = dict(source=ifn, output=ofn, ok=True, error=None, lines=0, seconds=0.0)
+    if stats or profile:
+        kwa['stats'] = RenderStats(memory=profile)
+    try:
+        hroff = HROFFFile(ifn, **kwa)
+        try:
+            hroff.run()
+            hroff.save(ofn)
+        except SystemExit:  # !exit saves before bailing out;
+            pass
+        status['lines'] = hroff._input_len
+        status['output'] = hroff._ofn
+        status['changed'] = hroff._changed
+        status['deps'] = hroff.dependencies
+        if hroff.stats is not None:
+            status['stats'] = hroff.stats.as_dict()
+    except Exception as e:
+        status['ok'] = False
+        status['error'] = f"{type(e).__name__}: {e}"
+    status['seconds'] = time.perf_counter() - t0
+    return status
+
+
+def build(paths: List[str], jobs: int = None, report = None, manifest: BuildManifest = None,
+          **kwa: dict) -> List[Dict]:
+    """Render every .hroff under paths across a process pool; jobs=None uses every core
+
+    With a manifest, only pages whose source, included/fragmented files or output changed are rendered.
+    kwa are passed through to HROFFFile."""
+    sources = discover_sources(paths)
+    if manifest is not None:
+        sources = [ ifn for ifn in sources if manifest.stale(ifn) ]
+        report = _recording(manifest, report)
+    jobs = jobs or os.cpu_count() or 1
+    jobs = min(jobs, len(sources)) or 1
+    results = [ ]
+    if jobs == 1:
+        for ifn in sources:
+            status = render_file(ifn, **kwa)
+            results.append(status)
+            if report:
+                report(status)
+        return results
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [ pool.submit(render_file, ifn, **kwa) for ifn in sources ]
+        for future in as_completed(futures):
+            status = future.result()
+            results.append(status)
+            if report:
+                report(status)
+    return results
+
+
+class Watcher():
+    """Poll sources and every file they !include/!fragment, re-rendering only the pages a change affects
+
+    Everything happens in this one process, so the interpreter, SOURCE_CACHE and any AST caches stay warm.
+    A missing include is watched where it was looked for (see HROFFFile._missing_file), so creating it is a change.
+    Watched files are stat'd a directory at a time with os.scandir; a directory whose mtime moves is
+    re-searched for new or deleted sources.
+    """
+    def __init__(self, paths: List[str], interval: float = 0.02, report = None, **kwa: dict) -> NoReturn:
+        self._paths = paths
+        self._interval = interval
+        self._report = report
+        self._kwa = kwa                 # HROFFFile options;
+        self._pages = { }               # source -> [ deps ]
+        self._users = { }               # watched file -> { sources that read it (a source reads itself) }
+        self._stamps = { }              # watched file -> (mtime_ns, size), None if missing
+        self._dirs = { }                # directory sources are discovered in -> mtime_ns
 
-    def warning(self, s: str) -> NoReturn:
-        self.append(f"<!-- WARNING: {s} -->")
-        return
+    @staticmethod
+    def _stamp(st) -> tuple:
+        return ( st.st_mtime_ns, st.st_size )
+
+    def _watch(self, fn: str, source: str) -> NoReturn:
+        if fn not in self._users:
+            self._users[fn] = set()
+            try:
+                self._stamps[fn] = Watcher._stamp(os.stat(fn))
+            except OSError:
+                self._stamps[fn] = None
+        self._users[fn].add(source)
+
+    def _unwatch(self, source: str) -> NoReturn:
+        for fn in [ source ] + self._pages.pop(source, [ ]):
+            users = self._users.get(fn, None)
+            if users is None:
+                continue
+            users.discard(source)
+            if not users:
+                del self._users[fn]
+                del self._stamps[fn]
+
+    def _sources(self) -> List[str]:
+        sources = [ os.path.abspath(fn) for fn in discover_sources(self._paths) ]
+        roots = [ os.path.abspath(path) for path in self._paths if os.path.isdir(path) ]
+        dirs = set(roots) | { os.path.dirname(fn) for fn in sources }
+        for dirpath in roots:
+            for parent, dirnames, filenames in os.walk(dirpath):
+                dirs.update(os.path.join(parent, dn) for dn in dirnames)
+        self._dirs = { }
+        for dirpath in dirs:
+            try:
+                self._dirs[dirpath] = os.stat(dirpath).st_mtime_ns
+            except OSError:
+                pass
+        return sources
+
+    def render(self, source: str, t0: float = None) -> Dict:
+        status = render_file(source, **self._kwa)
+        deps = self._pages.get(source, [ ])
+        if status['ok']:
+            deps = [ os.path.abspath(dep) for dep in status.get('deps', [ ]) ]
+        self._unwatch(source)
+        self._pages[source] = deps
+        for fn in [ source ] + deps:
+            self._watch(fn, source)
+        if t0 is not None:
+            status['latency'] = time.perf_counter() - t0
+        if self._report:
+            self._report(status)
+        return status
+
+    def build(self) -> List[Dict]:
+        """Render every source once, which is also how their dependencies are learned"""
+        return [ self.render(source) for source in self._sources() ]
+
+    def _changed(self) -> List[str]:
+        by_dir = { }
+        for fn in self._stamps:
+            parent, fn_only = os.path.split(fn)
+            by_dir.setdefault(parent, { })[fn_only] = fn
+        changed = [ ]
+        for parent, names in by_dir.items():
+            seen = set()
+            try:
+                with os.scandir(parent) as entries:
+                    for entry in entries:
+                        fn = names.get(entry.name, None)
+                        if fn is None:
+                            continue
+                        seen.add(fn)
+                        try:
+                            stamp = Watcher._stamp(entry.stat())
+                        except OSError:
+                            stamp = None
+                        if stamp != self._stamps[fn]:
+                            self._stamps[fn] = stamp
+                            changed.append(fn)
+            except OSError:
+                pass
+            for fn in names.values():
+                if fn not in seen and self._stamps[fn] is not None:
+                    self._stamps[fn] = None
+                    changed.append(fn)
+        return changed
+
+    def _dirs_changed(self) -> bool:
+        for dirpath, mtime_ns in self._dirs.items():
+            try:
+                if os.stat(dirpath).st_mtime_ns != mtime_ns:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def poll(self) -> List[Dict]:
+        """One pass: re-render pages whose source or dependencies changed, and any new sources"""
+        t0 = time.perf_counter()
+        affected = set()
+        for fn in self._changed():
+            affected |= self._users.get(fn, set())
+        if self._dirs_changed():
+            sources = set(self._sources())
+            for source in list(self._pages):
+                if source not in sources:
+                    self._unwatch(source)
+                    affected.discard(source)
+            affected |= sources - set(self._pages)
+        return [ self.render(source, t0) for source in sorted(affected) if os.path.isfile(source) ]
 
+    def run(self) -> NoReturn:
+        self.build()
+        while True:
+            t0 = time.perf_counter()
+            self.poll()
+            time.sleep(max(0.0, self._interval - (time.perf_counter() - t0)))
 
-if __name__ == "__main__":
 
-    pname, *args = sys.argv[:]
-    args = list(args)
+class Template():
+    """A page source with {{field}} slots, compiled once and rendered once per record (hroff --data)
 
-    if not args:
-        print(f"No filename provided on command line")
-        sys.exit(1)
-    args = list(args)
-    ifn = args.pop(0)
-    hroff = HROFFFile(ifn)
-    hroff.run()
-    ofn = None if not args else args.pop(0)
-    hroff.save(ofn)
-    sys.exit(0)
+    The source becomes a Macro over every field it uses, so lines without a slot are lexed once for all the pages
+    and the rest are string joins; per page, only the render and the write are left.
+    """
+    OUTPUT_FIELD = re.compile(r'\{\{\s*(\w+|#)\s*\}\}')
 
+    def __init__(self, fn: str, escape: bool = False) -> NoReturn:
+        self._fn = fn
+        self._escape = escape
+        lines = list(MappedLines(fn, skip_comments=True))
+        self.fields = tuple(dict.fromkeys(Macro.PARAM.findall("\n".join(lines))))
+        self._macro = Macro(os.path.basename(fn), self.fields, lines)
+
+    def arguments(self, record: Dict) -> tuple:
+        """record's values for the template's fields, in order; missing fields are empty"""
+        values = tuple(_json_cell(record.get(field, None)) for field in self.fields)
+        if self._escape:
+            import html
+            values = tuple(html.escape(value) for value in values)
+        return values
+
+    def render(self, args: tuple, ofn: str, **kwa: dict) -> Dict:
+        """Render the page for args (see arguments) to ofn; never raises, returns a status dict like render_file's
+
+        kwa are HROFFFile options."""
+        t0 = time.perf_counter()
+        status = dict(source=self._fn, output=ofn, ok=True, error=None, lines=0, seconds=0.0)
+        try:
+            doc = HROFFFile(self._fn, tokens=self._macro.expand(args, literal=True), base_dir=os.path.dirname(self._fn),
+                            **kwa)
+            doc.run()
+            doc.save(ofn)
+            status['lines'] = doc._input_len
+            status['changed'] = doc._changed
+        except Exception as e:
+            status['ok'] = False
+            status['error'] = f"{type(e).__name__}: {e}"
+        status['seconds'] = time.perf_counter() - t0
+        return status
 
+    @staticmethod
+    def output_name(pattern: str, record: Dict, index: int) -> str:
+        """pattern with {{field}} replaced from record and {{#}} by index; values can't add directories"""
+        def value(mtch) -> str:
+            v = str(index) if mtch.group(1) == '#' else _json_cell(record.get(mtch.group(1), None))
+            return v.replace(os.sep, '_') if os.altsep is None else v.replace(os.sep, '_').replace(os.altsep, '_')
+        return Template.OUTPUT_FIELD.sub(value, pattern)
+
+
+def load_records(fn: str, fmt: str = None) -> List[Dict]:
+    """The records of a dataset: json (a list of objects), jsonl, or csv/tsv whose first row names the fields"""
+    ext = os.path.splitext(fn)[1].lower()
+    fmt = fmt or ( 'json' if ext == '.json' else TABLE_FORMATS.get(ext, 'csv') )
+    if fmt in ( 'json', 'jsonl' ):
+        import json
+        with open(fn, 'r') as ifd:
+            records = json.load(ifd) if fmt == 'json' else [ json.loads(ln) for ln in ifd if ln.strip() ]
+        if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+            raise RuntimeError(f"{fn}: expected {'a list of objects' if fmt == 'json' else 'an object per line'}")
+        return records
+    rows = table_data_rows(_read_lines(fn), fmt, header=True)
+    names = next(rows, [ ])
+    return [ dict(zip(names, row)) for row in rows if row ]
+
+
+_TEMPLATES = { }    # real path -> ( (mtime_ns, size), Template ), so each worker compiles a template once;
+
+
+def _render_pages(fn: str, pages: List, options: Dict) -> List[Dict]:
+    # Runs in a worker: pages are ( output path, arguments );
+    st = os.stat(fn)
+    key, stamp = os.path.realpath(fn), ( st.st_mtime_ns, st.st_size )
+    known = _TEMPLATES.get(key, None)
+    if known is None or known[0] != stamp:
+        known = _TEMPLATES[key] = ( stamp, Template(fn) )
+    return [ known[1].render(args, ofn, **options) for ofn, args in pages ]
+
+
+def render_records(template: str, records: List[Dict], pattern: str = None, jobs: int = None, escape: bool = False,
+                   report = None, batch: int = 200, **kwa: dict) -> List[Dict]:
+    """Render template once per record, to pattern's name for it (see Template.output_name), across a process pool
+
+    The default pattern is <template>-{{#}}.html.  Records are handed out batch at a time; jobs=None uses every
+    core.  Returns a status per page, as build does; kwa are HROFFFile options."""
+    compiled = Template(template, escape=escape)
+    pattern = pattern or f"{os.path.splitext(template)[0]}-{{{{#}}}}.html"
+    pages, seen = [ ], { }
+    for index, record in enumerate(records):
+        ofn = Template.output_name(pattern, record, index)
+        if ofn in seen:
+            raise RuntimeError(f"records {seen[ofn]} and {index} would both be written to {ofn}")
+        seen[ofn] = index
+        pages.append(( ofn, compiled.arguments(record) ))
+    for out_dir in dict.fromkeys(os.path.dirname(ofn) for ofn in seen):
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+    batches = [ pages[i:i + batch] for i in range(0, len(pages), batch) ]
+    jobs = min(jobs or os.cpu_count() or 1, len(batches)) or 1
+    results = [ ]
+    if jobs == 1:
+        for part in batches:
+            for status in _render_pages(template, part, kwa):
+                results.append(status)
+                if report:
+                    report(status)
+        return results
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [ pool.submit(_render_pages, template, part, kwa) for part in batches ]
+        for future in as_completed(futures):
+            for status in future.result():
+                results.append(status)
+                if report:
+                    report(status)
+    return results
+
+
+def _recording(manifest: BuildManifest, report):
+    def record(status: Dict) -> NoReturn:
+        manifest.record(status)
+        if report:
+            report(status)
+    return record
+
+
+def _emit_stats(fn: str, stats: Dict) -> NoReturn:
+    import json
+    if fn == HROFFFile.STDIO:
+        print(json.dumps(stats, indent=1, sort_keys=True), file=sys.stderr)
+        return
+    with open(fn, 'w') as ofd:
+        json.dump(stats, ofd, indent=1, sort_keys=True)
+
+
+def _report_status(status: Dict) -> NoReturn:
+    if status['ok']:
+        latency = f", {status['latency'] * 1000:.1f} ms since change seen" if 'latency' in status else ""
+        print(f"ok     {status['source']} -> {status['output']} ({status['seconds'] * 1000:.1f} ms{latency})",
+              flush=True)
+    else:
+        print(f"FAILED {status['source']}: {status['error']}", file=sys.stderr)
+
+
+def _render_data(args, report, options: Dict) -> int:
+    t0 = time.perf_counter()
+    options.pop('targets', None)
+    results = render_records(args.paths[0], load_records(args.data), pattern=(args.paths[1:] or [ None ])[0],
+                             jobs=args.jobs, escape=args.escape, report=report, **options)
+    elapsed = time.perf_counter() - t0
+    failed = [ status for status in results if not status['ok'] ]
+    print(f"{len(results)} pages ({len(failed)} failed) in {elapsed:.2f}s: "
+          f"{len(results) / elapsed if elapsed else 0.0:.1f} pages/s")
+    return 1 if failed else 0
+
+
+def main(argv: List[str] = None) -> int:
+    import argparse
+    parser = argparse.ArgumentParser(prog='hroff', description="runoff-style to html")
+    parser.add_argument('paths', nargs='*', help="<input-file> [<output-file>] ('-' is stdin/stdout), "
+                                                 "or files/directories/globs with -b")
+    parser.add_argument('-b', '--batch', action='store_true', help="render every .hroff found under paths")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="batch worker processes (default: all cores)")
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help="batch: only re-render pages whose inputs changed since the last build")
+    parser.add_argument('--manifest', default='.hroff-manifest.json', help="incremental build manifest file")
+    parser.add_argument('-q', '--quiet', action='store_true', help="batch: only report failures")
+    parser.add_argument('-s', '--stream', action='store_true',
+                        help="render and write incrementally, keeping memory flat (implied by '-' input)")
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help="render everything, then keep re-rendering pages whose sources/includes change")
+    parser.add_argument('--interval', type=float, default=0.02, help="watch: seconds between polls")
+    parser.add_argument('--stats', action='store_true',
+                        help="emit per-phase/element/directive counts and times as JSON")
+    parser.add_argument('--profile', action='store_true', help="--stats plus the tracemalloc peak (slower)")
+    parser.add_argument('--stats-file', default=HROFFFile.STDIO, metavar='FILE',
+                        help="where --stats/--profile JSON goes (default: stderr)")
+    parser.add_argument('-a', '--ast-cache', action='store_true',
+                        help="keep each source's parsed AST in .<name>.ast beside it; unchanged sources skip lexing")
+    parser.add_argument('--chunk-jobs', type=int, default=None, metavar='N',
+                        help="render one big source in line chunks across N processes (not with -s/-a/--stats)")
+    parser.add_argument('-m', '--minify', action='store_true', help="trim whitespace from the html output")
+    parser.add_argument('-z', '--gzip', action='store_true', help="also write a precompressed <output>.gz")
+    parser.add_argument('--gzip-level', type=int, default=9, metavar='N', help="-z compression level (1-9)")
+    parser.add_argument('--etag', action='store_true', help="write an <output>.etag sidecar with the content hash")
+    parser.add_argument('--fingerprint', action='store_true',
+                        help="link css/js by content-hashed names, written beside each output")
+    parser.add_argument('--minify-assets', action='store_true', help="minify inlined and fingerprinted css/js")
+    parser.add_argument('--target', action='append', default=[ ], metavar='KIND=PATH',
+                        help=f"write the page as KIND ({', '.join(HROFFFile.TARGETS)}) to PATH instead of the default "
+                             "output, all from one render; {stem} is the source path without .hroff (repeatable, not with -s)")
+    parser.add_argument('--prefetch', type=int, default=None, metavar='N',
+                        help="read all !include/!fragment files on N threads before rendering (slow filesystems)")
+    parser.add_argument('--prefetch-timeout', type=float, default=30.0, metavar='SECONDS',
+                        help="--prefetch: stop waiting after this long, and read what's left in line")
+    parser.add_argument('--data', metavar='FILE',
+                        help="render <template> [<output-pattern>] once per record of a json/jsonl/csv/tsv dataset; "
+                             "{{field}} in either is the record's value, {{#}} in the pattern its index")
+    parser.add_argument('--escape', action='store_true', help="--data: html-escape the values")
+    args = parser.parse_args(argv)
+    targets = [ tuple(target.split('=', 1)) for target in args.target ]
+    for target in targets:
+        if len(target) != 2 or target[0] not in HROFFFile.TARGETS or not target[1]:
+            parser.error(f"--target {'='.join(target)}: expected KIND=PATH, KIND one of {', '.join(HROFFFile.TARGETS)}")
+    if targets and ( args.stream or HROFFFile.STDIO in args.paths[:1] ):
+        parser.error("--target needs a whole-page render; not with -s or '-' input")
+
+    if not args.paths:
+        print(f"No filename provided on command line")
+        return 1
+    options = dict(ast_cache=args.ast_cache, fingerprint=args.fingerprint, minify_assets=args.minify_assets,
+                   minify=args.minify, gzip_level=args.gzip_level if args.gzip else None, etag=args.etag,
+                   targets=targets, prefetch=args.prefetch, prefetch_timeout=args.prefetch_timeout)
+    report = _report_status
+    if args.quiet:
+        report = lambda status: None if status['ok'] else _report_status(status)
+    if args.data:
+        if targets or args.stream or len(args.paths) > 2:
+            parser.error("--data takes <template> [<output-pattern>], without --target or -s")
+        return _render_data(args, report, options)
+    if args.watch:
+        try:
+            Watcher(args.paths, interval=args.interval, report=report, **options).run()
+        except KeyboardInterrupt:
+            pass
+        return 0
+    import glob
+    batch = args.batch or args.incremental or (args.jobs is not None) or len(args.paths) > 2
+    batch |= any(os.path.isdir(path) or glob.has_magic(path) for path in args.paths if path != HROFFFile.STDIO)
+    stats_fn = args.stats_file if (args.stats or args.profile) else None
+    if not batch:
+        ifn, *rest = args.paths
+        stats = RenderStats(memory=args.profile) if stats_fn else None
+        hroff = HROFFFile(ifn, stream=args.stream, stats=stats, chunk_jobs=args.chunk_jobs, **options)
+        hroff.run()
+        ofn = None if not rest else rest[0]
+        hroff.save(ofn)
+        if stats is not None:
+            _emit_stats(stats_fn, stats.as_dict())
+        return 0
+
+    t0 = time.perf_counter()
+    manifest = BuildManifest(args.manifest) if args.incremental else None
+    results = build(args.paths, jobs=args.jobs, report=report, manifest=manifest,
+                    stream=args.stream, stats=args.stats, profile=args.profile, **options)
+    if manifest is not None:
+        manifest.save()
+    elapsed = time.perf_counter() - t0
+    failed = [ status for status in results if not status['ok'] ]
+    lines = sum(status['lines'] for status in results)
+    rate = len(results) / elapsed if elapsed else 0.0
+    print(f"{len(results)} files ({len(failed)} failed), {lines} lines in {elapsed:.2f}s: "
+          f"{rate:.1f} files/s, {lines / elapsed if elapsed else 0.0:.0f} lines/s")
+    if stats_fn:
+        _emit_stats(stats_fn, RenderStats.merge([ status['stats'] for status in results if 'stats' in status ]))
+    return 1 if failed else 0
 
 
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,194 @@
+#!/bin/env python3
+"""
+hroff_daemon -- keep hroff resident, so each render from make & co. doesn't pay interpreter start and imports;
+
+    % hroff_daemon.py --serve [--socket <path>]     run the daemon (in the foreground)
+    % hroff_daemon.py --stop [--socket <path>]      ask a running daemon to exit
+    % hroff_daemon.py <hroff arguments>             render through the daemon, as `hroff <arguments>` would
+
+The client only imports what it needs to talk to the socket: it sends argv, the working directory and (for '-'
+input) stdin, and gets back the exit status plus whatever hroff wrote to stdout/stderr.  With no daemon listening
+it runs hroff in-process instead, so it's always safe to call.  The daemon runs requests itself, one at a time, so
+what one render caches stays for the next: imports and compiled regexes, and SOURCE_CACHE's file lines, rendered
+includes and inline assets (re-validated against each file's mtime/size, so edits are picked up).  Requests are
+serialized because a render changes process-wide state (the working directory, stdin/stdout/stderr); make -j
+clients queue on the socket, and hroff -j within a request still renders across processes.
+The socket defaults to $HROFF_SOCKET, or hroff-<uid>.sock in $XDG_RUNTIME_DIR or the temp directory; only the
+daemon's own user may connect.
+"""
+
+if True:
+    # The client's imports are its startup cost: marshal (builtin) rather than json, whose import pulls in re,
+    # and no typing (annotations are strings);
+    import marshal
+    import os
+    import socket
+    import sys
+
+# Run hroff locally rather than in the daemon: these never finish, or need the terminal;
+LOCAL_ONLY = ( '-w', '--watch' )
+# hroff options that take a value, so the input path can be found without importing argparse;
+VALUE_OPTIONS = ( '-j', '--jobs', '--manifest', '--interval', '--stats-file', '--chunk-jobs', '--gzip-level',
+                  '--target', '--data', '--prefetch', '--prefetch-timeout' )
+
+
+def _reads_stdin(argv: 'List[str]') -> bool:
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in VALUE_OPTIONS:
+            skip = True
+        elif arg == '-' or not arg.startswith('-'):
+            return arg == '-'
+    return False
+
+
+def socket_path() -> str:
+    if os.environ.get('HROFF_SOCKET'):
+        return os.environ['HROFF_SOCKET']
+    runtime = os.environ.get('XDG_RUNTIME_DIR', None)
+    if not runtime:
+        import tempfile
+        runtime = tempfile.gettempdir()
+    return os.path.join(runtime, f"hroff-{os.getuid()}.sock")
+
+
+def _send(sock, message: 'Dict') -> 'NoReturn':
+    sock.sendall(marshal.dumps(message))
+    sock.shutdown(socket.SHUT_WR)
+
+
+def _receive(sock) -> 'Dict':
+    chunks = [ ]
+    while True:
+        chunk = sock.recv(1 << 16)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return marshal.loads(b"".join(chunks)) if chunks else None
+
+
+def request(argv: 'List[str]', path: str = None) -> 'Dict':
+    """Have the daemon run hroff argv in our cwd; None if no daemon is listening"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path or socket_path())
+    except OSError:
+        sock.close()
+        return None
+    stdin = sys.stdin.read() if _reads_stdin(argv) else None
+    with sock:
+        _send(sock, dict(argv=argv, cwd=os.getcwd(), stdin=stdin))
+        return _receive(sock)
+
+
+def _run(message: 'Dict') -> 'Dict':
+    # Daemon side: hroff.main as if it were started in the client's directory, then the daemon's state put back;
+    import contextlib, io
+    import hroff
+    out, err = io.StringIO(), io.StringIO()
+    code = 0
+    cwd, stdin = os.getcwd(), sys.stdin
+    try:
+        os.chdir(message['cwd'])
+        if message.get('stdin', None) is not None:
+            sys.stdin = io.StringIO(message['stdin'])
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            try:
+                code = hroff.main(message['argv'])
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception as e:
+        err.write(f"hroff_daemon: {type(e).__name__}: {e}\n")
+        code = 1
+    finally:
+        sys.stdin = stdin
+        os.chdir(cwd)
+    return dict(code=code or 0, stdout=out.getvalue(), stderr=err.getvalue())
+
+
+def serve(path: str = None) -> 'NoReturn':
+    import hroff    # Imported (and its regexes compiled) once, here, for every request;
+    path = path or socket_path()
+    if os.path.exists(path):
+        if request_stop(path):
+            print(f"hroff_daemon: stopped the daemon already on {path}", file=sys.stderr)
+        if os.path.exists(path):
+            os.remove(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o077)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(umask)
+    listener.listen(64)
+    print(f"hroff_daemon: listening on {path}", file=sys.stderr, flush=True)
+    try:
+        while True:
+            conn, _ = listener.accept()
+            with conn:
+                conn.settimeout(30)
+                try:
+                    message = _receive(conn) if _same_user(conn) else None
+                except (OSError, ValueError, EOFError, TypeError):
+                    message = None
+                if not isinstance(message, dict):
+                    continue
+                if message.get('stop', False):
+                    _send(conn, dict(code=0, stdout="", stderr=""))
+                    break
+                reply = _run(message)
+                try:
+                    _send(conn, reply)
+                except OSError:
+                    pass        # The client went away; the render still warmed the caches;
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _same_user(conn) -> bool:
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return True         # The socket's 0600 mode is all there is;
+    import struct
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1] == os.getuid()
+
+
+def request_stop(path: str = None) -> bool:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path or socket_path())
+    except OSError:
+        sock.close()
+        return False
+    with sock:
+        _send(sock, dict(stop=True))
+        return _receive(sock) is not None
+
+
+def main(argv: 'List[str]' = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    path = None
+    if argv[:1] in ( [ '--serve' ], [ '--stop' ] ) and argv[1:2] == [ '--socket' ] and len(argv) > 2:
+        path = argv[2]
+    if argv[:1] == [ '--serve' ]:
+        serve(path)
+        return 0
+    if argv[:1] == [ '--stop' ]:
+        return 0 if request_stop(path) else 1
+    reply = None if any(arg in LOCAL_ONLY for arg in argv) else request(argv)
+    if reply is None:
+        import hroff
+        return hroff.main(argv)
+    sys.stdout.write(reply['stdout'])
+    sys.stderr.write(reply['stderr'])
+    return reply['code']
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,297 @@
+#!/bin/env python3
+"""
+hroff_server -- render hroff on demand over HTTP (TCP or a Unix socket), with an output cache;
+
+    % hroff_server.py [--host 127.0.0.1] [--port 8080 | --unix <path>] [--root <dir>] [--workers N]
+
+    GET  /render?path=<file under root>     render a source file
+    POST /render                            render the request body (includes resolve under root)
+    GET  /stats                             cache counters, as JSON
+
+Renders run in a process pool, so the event loop never waits on HROFFFile.run.  Outputs are cached by
+the content hash of the source plus every file it included; that hash is also the ETag, so a client
+sending If-None-Match gets a 304 without the page being rendered (or even looked up) again.
+"""
+
+if True:
+    import asyncio
+    from   collections import OrderedDict
+    import hashlib
+    import json
+    import os
+    import sys
+    from   typing import Dict, List, NoReturn, Tuple
+    from   urllib.parse import parse_qs, urlsplit
+    import hroff
+
+REASONS = { 200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+            405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error' }
+
+
+class RootResolver():
+    """!include/!fragment, asset and table-data lookups for a render, confined to root
+
+    A name is looked for beside the page (base), then under root; one that resolves outside root (absolute, or
+    through '..' or a symlink) is no such file.  paths collects every real path looked at, found or not, so the
+    render's cache entry is invalidated when one of them changes or turns up."""
+    def __init__(self, root: str, base: str = None) -> NoReturn:
+        self._root = root
+        self._bases = [ root ] if base in ( None, root ) else [ base, root ]
+        self.paths = [ ]
+
+    def __call__(self, name: str, directive: str) -> List[str]:
+        for base in self._bases:
+            fn = os.path.realpath(os.path.join(base, name))
+            if not fn.startswith(self._root + os.sep):
+                continue
+            if fn not in self.paths:
+                self.paths.append(fn)
+            if os.path.isfile(fn):
+                return hroff.SOURCE_CACHE.lines(fn)
+        return None
+
+
+def _render_text(text: str, root: str) -> Tuple[str, List[str]]:
+    # Runs in a worker process;
+    resolver = RootResolver(root)
+    doc = hroff.HROFFFile('<request>', lines=text.splitlines(), base_dir=root, resolver=resolver)
+    doc.run()
+    return "\n".join(doc._iter_html()), resolver.paths
+
+
+def _render_path(fn: str, root: str) -> Tuple[str, List[str]]:
+    # Runs in a worker process; the source is its own first dependency.  Read as in-memory input, so !exit just
+    # ends the document rather than saving the page beside its source and exiting;
+    resolver = RootResolver(root, os.path.dirname(fn))
+    doc = hroff.HROFFFile(fn, lines=hroff.MappedLines(fn, skip_comments=True), base_dir=os.path.dirname(fn),
+                          resolver=resolver)
+    doc.run()
+    return "\n".join(doc._iter_html()), [ fn ] + resolver.paths
+
+
+class RenderServer():
+    MAX_BODY = 16 << 20
+    HASHES_PER_ENTRY = 8    # Dependency hashes kept per cached page, on average;
+
+    def __init__(self, root: str = '.', workers: int = None, cache_size: int = 1024) -> NoReturn:
+        self._root = os.path.realpath(root)
+        self._workers = workers
+        self._pool = None
+        self._cache = OrderedDict()     # key (and ETag) -> html bytes
+        self._cache_size = cache_size
+        # Both LRUs, bounded like the cache, so distinct requests (every POST body is one) can't grow them for ever;
+        self._deps = OrderedDict()      # request identity -> [ dependency paths ] from its last render
+        self._hashes = OrderedDict()    # path -> ( (mtime_ns, size), sha1 ), so unchanged deps aren't re-read
+        self._counters = dict(requests=0, hits=0, misses=0, not_modified=0, errors=0)
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8080, unix: str = None):
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        # Forked workers would inherit open client sockets (holding connections open) and lock state from
+        # the executor threads; forkserver/spawn children start clean;
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self._pool = ProcessPoolExecutor(max_workers=self._workers, mp_context=multiprocessing.get_context(method))
+        if unix:
+            return await asyncio.start_unix_server(self._connection, path=unix)
+        return await asyncio.start_server(self._connection, host, port)
+
+    def close(self) -> NoReturn:
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def _digest(self, fn: str) -> str:
+        try:
+            st = os.stat(fn)
+        except OSError:
+            return 'missing'
+        stamp = ( st.st_mtime_ns, st.st_size )
+        known = self._hashes.get(fn, None)
+        if known and known[0] == stamp:
+            self._hashes.move_to_end(fn)
+            return known[1]
+        with open(fn, 'rb') as ifd:
+            sha1 = hashlib.sha1(ifd.read()).hexdigest()
+        self._hashes[fn] = ( stamp, sha1 )
+        self._hashes.move_to_end(fn)
+        while len(self._hashes) > self._cache_size * RenderServer.HASHES_PER_ENTRY:
+            self._hashes.popitem(last=False)
+        return sha1
+
+    def _known_deps(self, identity: str) -> List[str]:
+        deps = self._deps.get(identity, None)
+        if deps is not None:
+            self._deps.move_to_end(identity)
+        return deps
+
+    def _key(self, identity: str, deps: List[str]) -> str:
+        h = hashlib.sha1(identity.encode())
+        for fn in deps:
+            h.update(f"\0{fn}\0{self._digest(fn)}".encode())
+        return h.hexdigest()
+
+    async def render(self, identity: str, work, *args) -> Tuple[str, bytes]:
+        """(ETag, html) for a request, from the cache when none of its inputs changed since it was rendered"""
+        loop = asyncio.get_running_loop()
+        deps = self._known_deps(identity)
+        if deps is not None:
+            key = await loop.run_in_executor(None, self._key, identity, deps)
+            html = self._cache.get(key, None)
+            if html is not None:
+                self._cache.move_to_end(key)
+                self._counters['hits'] += 1
+                return key, html
+        self._counters['misses'] += 1
+        text, deps = await loop.run_in_executor(self._pool, work, *args)
+        self._deps[identity] = deps
+        self._deps.move_to_end(identity)
+        while len(self._deps) > self._cache_size:
+            self._deps.popitem(last=False)
+        key = await loop.run_in_executor(None, self._key, identity, deps)
+        html = self._cache[key] = text.encode()
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return key, html
+
+    async def etag(self, identity: str) -> str:
+        """The ETag the cached render of identity would have now, without rendering; None if unknown"""
+        deps = self._known_deps(identity)
+        if deps is None:
+            return None
+        key = await asyncio.get_running_loop().run_in_executor(None, self._key, identity, deps)
+        return key if key in self._cache else None
+
+    def stats(self) -> Dict:
+        return dict(self._counters, entries=len(self._cache))
+
+    async def _connection(self, reader, writer) -> NoReturn:
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body, refused = request
+                if refused:
+                    # The body wasn't read, so the rest of the stream can't be trusted to start a request;
+                    self._counters['requests'] += 1
+                    status, extra, payload, keep_alive = refused, { }, b'', False
+                else:
+                    status, extra, payload = await self._handle(method, target, headers, body)
+                    keep_alive = headers.get('connection', '').lower() != 'close'
+                self._respond(writer, status, extra, payload, keep_alive, method == 'HEAD')
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError:
+            return None
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ', 2)
+        except ValueError:
+            return None
+        headers = { }
+        for ln in lines[1:]:
+            if ':' in ln:
+                k, v = ln.split(':', 1)
+                headers[k.strip().lower()] = v.strip()
+        try:
+            length = int(headers.get('content-length', 0) or 0)
+        except ValueError:
+            return method, target, headers, b'', 400
+        if length < 0:
+            return method, target, headers, b'', 400
+        if length > RenderServer.MAX_BODY:
+            return method, target, headers, b'', 413
+        body = await reader.readexactly(length) if length else b''
+        return method, target, headers, body, None
+
+    async def _handle(self, method: str, target: str, headers: Dict, body: bytes):
+        self._counters['requests'] += 1
+        url = urlsplit(target)
+        if url.path == '/stats':
+            return 200, { 'Content-Type': 'application/json' }, json.dumps(self.stats()).encode()
+        if url.path != '/render':
+            return 404, { }, b''
+        if method in ( 'GET', 'HEAD' ):
+            paths = parse_qs(url.query).get('path', [ ])
+            if not paths:
+                return 400, { }, b'path= is required\n'
+            fn = os.path.realpath(os.path.join(self._root, paths[0]))
+            if not fn.startswith(self._root + os.sep):
+                return 403, { }, b''
+            if not os.path.isfile(fn):
+                return 404, { }, b''
+            identity, work, args = f"path:{fn}", _render_path, ( fn, self._root )
+        elif method == 'POST':
+            text = body.decode('utf-8', errors='replace')
+            identity = f"text:{hashlib.sha1(body).hexdigest()}"
+            work, args = _render_text, ( text, self._root )
+        else:
+            return 405, { 'Allow': 'GET, HEAD, POST' }, b''
+        wanted = [ tag.strip().removeprefix('W/').strip('"') for tag in headers.get('if-none-match', '').split(',') ]
+        if wanted != [ '' ]:
+            etag = await self.etag(identity)
+            if etag is not None and ( etag in wanted or '*' in wanted ):
+                self._counters['not_modified'] += 1
+                return 304, { 'ETag': f'"{etag}"' }, b''
+        try:
+            etag, html = await self.render(identity, work, *args)
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:     # SystemExit from a render too: it's that request's failure, not ours;
+            self._counters['errors'] += 1
+            return 500, { }, f"{type(e).__name__}: {e}\n".encode()
+        return 200, { 'Content-Type': 'text/html; charset=utf-8', 'ETag': f'"{etag}"',
+                      'Cache-Control': 'no-cache' }, html
+
+    def _respond(self, writer, status: int, extra: Dict, payload: bytes, keep_alive: bool, head: bool) -> NoReturn:
+        lines = [ f"HTTP/1.1 {status} {REASONS.get(status, '')}", f"Content-Length: {len(payload)}" ]
+        lines += [ f"{k}: {v}" for k, v in extra.items() ]
+        if not keep_alive:
+            lines.append("Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+        if payload and not head and status != 304:
+            writer.write(payload)
+
+
+async def serve(host: str = '127.0.0.1', port: int = 8080, unix: str = None, root: str = '.',
+                workers: int = None, cache_size: int = 1024) -> NoReturn:
+    server = RenderServer(root=root, workers=workers, cache_size=cache_size)
+    listener = await server.start(host=host, port=port, unix=unix)
+    where = unix or f"http://{host}:{port}"
+    print(f"hroff_server: serving {server._root} on {where}", flush=True)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+
+def main(argv: List[str] = None) -> int:
+    import argparse
+    parser = argparse.ArgumentParser(prog='hroff_server', description="render hroff on demand")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix', default=None, metavar='PATH', help="listen on a Unix socket instead of TCP")
+    parser.add_argument('--root', default='.', help="directory sources and includes are served from")
+    parser.add_argument('--workers', type=int, default=None, help="render processes (default: all cores)")
+    parser.add_argument('--cache-size', type=int, default=1024, help="rendered pages kept")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(host=args.host, port=args.port, unix=args.unix, root=args.root,
+                          workers=args.workers, cache_size=args.cache_size))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())